@@ -1,11 +1,10 @@
 from flask import Flask, render_template, jsonify, redirect, request, abort
 from flask_sqlalchemy import SQLAlchemy
 from flask_httpauth import HTTPBasicAuth
-from http.cookies import SimpleCookie
 
 
 from wtforms import Form, StringField, RadioField, SubmitField, DecimalField, IntegerField, SelectField, BooleanField
-from wtforms.validators import DataRequired, NumberRange
+from wtforms.validators import DataRequired, NumberRange, ValidationError
 from wtforms.widgets import PasswordInput
 from apscheduler.schedulers.background import BackgroundScheduler
 
@@ -16,32 +15,75 @@ import math
 import json
 import shutil
 import argparse
-import requests as pyrequests
+import zlib
+import time
+import threading
+import signal
+import atexit
 import feedparser
+import waitress
 from urllib.parse import urlparse
 from datetime import datetime, timedelta
+from collections import OrderedDict
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 from loguru import logger
 
 import qbfunc
 import myconfig
+import migrations
+import rssfilter
+import infopage
+import retention
+import taskrunner
+import feedstream
+import metrics
+import lease
+import workerstats
 
 
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///db.sqlite'
+# TORRSS_DB: another database, e.g. the scratch one of bench/runbench.py
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('TORRSS_DB', 'sqlite:///db.sqlite')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 # app.config['SECRET_KEY'] = 'mykey'
+# static files: browsers keep them a week, then revalidate (ETag / Last-Modified)
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = timedelta(days=7)
 db = SQLAlchemy(app)
 
 auth = HTTPBasicAuth()
 
 
+@event.listens_for(Engine, 'connect')
+def setSqlitePragma(dbapi_connection, connection_record):
+    # WAL: the web UI keeps reading while a scheduler thread writes
+    if type(dbapi_connection).__module__.startswith('sqlite3'):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA busy_timeout=5000')
+        cursor.close()
+
+
+@app.before_request
+def reloadSettings():
+    # settings saved by another server process
+    myconfig.reloadConfig(ARGS.config)
+
+
 @auth.verify_password
 def verify_password(username, password):
+    # no user / password configured lets nobody in
+    if not username or not password:
+        return None
     if username == myconfig.CONFIG.basicAuthUser and password == myconfig.CONFIG.basicAuthPass:
         return username
 
 
-scheduler = BackgroundScheduler(job_defaults={'max_instances': 3})
+# jobs only hand the task to taskRunner, see rssJob; a job that fell behind
+# fires once, not once per missed interval
+scheduler = BackgroundScheduler(job_defaults={
+    'max_instances': 1, 'coalesce': True, 'misfire_grace_time': 300})
 
 
 LOG_FILE_NAME = "torrss.log"
@@ -66,6 +108,22 @@ class RSSTask(db.Model):
     last_update = db.Column(
         db.DateTime, default=datetime.now, onupdate=datetime.now)
     active = db.Column(db.SmallInteger, default=0)
+    # conditional GET validators, and counters of full fetches / 304 replies
+    etag = db.Column(db.String(256))
+    last_modified = db.Column(db.String(64))
+    fetch_count = db.Column(db.Integer, default=0)
+    notmodified_count = db.Column(db.Integer, default=0)
+    # adaptive polling: interval follows the feed's update rate, see
+    # adaptiveInterval; current_interval is the interval in use (minutes)
+    adaptive = db.Column(db.Boolean, default=False)
+    current_interval = db.Column(db.Float)
+    # set by the web UI's run-now, picked up by the worker holding the task
+    run_requested = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_rss_task_rsslink', 'rsslink'),
+        db.Index('ix_rss_task_site', 'site'),
+    )
 
     def to_dict(self):
         return {
@@ -81,6 +139,10 @@ class RSSTask(db.Model):
             'min_imdb': self.min_imdb,
             'qbcategory': self.qbcategory,
             'active': self.active,
+            'fetch_count': self.fetch_count or 0,
+            'notmodified_count': self.notmodified_count or 0,
+            'adaptive': bool(self.adaptive),
+            'current_interval': round(taskInterval(self), 1),
         }
 
 
@@ -97,6 +159,18 @@ class RSSHistory(db.Model):
     size = db.Column(db.BigInteger)
     infoLink = db.Column(db.String(255))
     downloadLink = db.Column(db.String(255))
+    guid = db.Column(db.String(255))
+
+    # keep in sync with migrations.migrateHistoryIndexes, one row per item
+    # and task (migrations.migrateTaskDecisions)
+    __table_args__ = (
+        db.Index('ux_rss_history_guid_tid', 'guid', 'tid', unique=True),
+        db.Index('ix_rss_history_title', 'title'),
+        db.Index('ix_rss_history_tid_addedon', 'tid', 'addedon'),
+        db.Index('ix_rss_history_addedon', 'addedon'),
+        db.Index('ix_rss_history_accept', 'accept'),
+        db.Index('ix_rss_history_site', 'site'),
+    )
 
     def to_dict(self):
         return {
@@ -112,24 +186,37 @@ class RSSHistory(db.Model):
         }
 
 
+def validRegex(form, field):
+    err = rssfilter.validateRegex(field.data, field.name)
+    if err:
+        raise ValidationError(f'正则表达式错误: {err}')
+
+
 class RSSTaskForm(Form):
     rsslink = StringField('RSS 链接', validators=[DataRequired()])
     cookie = StringField('Cookie')
-    title_regex = StringField('标题包含')
-    title_not_regex = StringField('标题不含')
-    info_regex = StringField('描述包含')
-    info_not_regex = StringField('描述不含')
+    title_regex = StringField('标题包含', validators=[validRegex])
+    title_not_regex = StringField('标题不含', validators=[validRegex])
+    info_regex = StringField('描述包含', validators=[validRegex])
+    info_not_regex = StringField('描述不含', validators=[validRegex])
     size_min = IntegerField('大小 (GB)', default=2)
     size_max = IntegerField('大小 (GB)', default=100)
     min_imdb = DecimalField('IMDb 大于', validators=[NumberRange(min=0, max=10)])
     task_interval = IntegerField('执行间隔 (分钟)', default=2)
+    adaptive = BooleanField('按更新频率自动调整间隔')
     qbcategory = StringField('加入qBit时带Category')
     submit = SubmitField("保存设置")
 
+    def validateRules(self):
+        # only the rule fields, the rest of the form is taken as is
+        fields = [self.title_regex, self.title_not_regex,
+                  self.info_regex, self.info_not_regex]
+        return all([f.validate(self) for f in fields])
+
 
 def initDatabase():
     with app.app_context():
-        db.create_all()
+        migrations.migrate(db.engine, db.Model.metadata.create_all)
 
 
 @app.route('/')
@@ -138,21 +225,127 @@ def index():
     return render_template('rsstasks.html')
 
 
+# with a search filter, count at most this many rows (approximate count)
+HISTORY_COUNT_CAP = 10000
+historyCursors = OrderedDict()
+historyCounts = OrderedDict()
+historyCacheLock = threading.Lock()
+
+
+def historyTotal():
+    # maintained by triggers, see migrations.migrateHistoryCount
+    total = db.session.execute(
+        db.text('SELECT total FROM rss_history_count WHERE id = 1')).scalar()
+    return total if total is not None else RSSHistory.query.count()
+
+
+def cacheGet(cache, key):
+    with historyCacheLock:
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+    return None
+
+
+def cachePut(cache, key, value, size=256):
+    with historyCacheLock:
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > size:
+            cache.popitem(last=False)
+
+
+_historyFts = None
+
+
+def historyFtsAvailable():
+    global _historyFts
+    if _historyFts is None:
+        _historyFts = db.session.execute(db.text(
+            "SELECT 1 FROM sqlite_master WHERE name = 'rss_history_fts'")).first() is not None
+    return _historyFts
+
+
+# ranking is kept to searches matching at most this many rows, ordering a
+# common term's matches by rank costs ~0.5 s at 1M rows and says little
+HISTORY_RANK_MAX = 10000
+# with the matches this dense, walking the rows in page order and testing
+# LIKE fills a page sooner than collecting every match from the index
+HISTORY_SCAN_RATIO = 5
+
+
+def ftsSearchable(search):
+    # the trigram index finds words of 3+ chars, shorter ones need LIKE
+    words = search.split()
+    return historyFtsAvailable() and bool(words) and all(len(w) >= 3 for w in words)
+
+
+def ftsMatchQuery(search):
+    # every word must occur, anywhere in the columns; quoted so FTS syntax is
+    # taken literally
+    words = search.split()
+    return ' '.join('"' + w.replace('"', '""') + '"' for w in words)
+
+
+historyFtsTable = db.table('rss_history_fts', db.column('rowid'), db.column('rank'))
+
+
+def historyLikeFilter(query, search):
+    for w in search.split():
+        pattern = f'%{w}%'
+        query = query.filter(db.or_(
+            RSSHistory.title.like(pattern),
+            RSSHistory.site.like(pattern),
+            RSSHistory.reason.like(pattern),
+            RSSHistory.imdbstr.like(pattern),
+        ))
+    return query
+
+
+def historySearchFilter(query, search, count, total, rows, ranked=False):
+    # count: matching rows, rows: rows up to the end of the page; ranked:
+    # join the full-text matches and order them best first
+    if not ftsSearchable(search):
+        return historyLikeFilter(query, search)
+    match = db.text('rss_history_fts MATCH :match').bindparams(
+        match=ftsMatchQuery(search))
+    if ranked:
+        return query.join(historyFtsTable, historyFtsTable.c.rowid == RSSHistory.id).filter(
+            match).order_by(historyFtsTable.c.rank, RSSHistory.id.desc())
+    # rows scanned in page order ~ rows * total / count, against count
+    # matches collected from the index
+    if rows * total < HISTORY_SCAN_RATIO * count * count:
+        return historyLikeFilter(query, search)
+    matched = db.select(historyFtsTable.c.rowid).select_from(historyFtsTable).where(match)
+    return query.filter(RSSHistory.id.in_(matched))
+
+
+def historyFilteredCount(search, total):
+    # cached per search term until the table changes (total moves)
+    cached = cacheGet(historyCounts, search)
+    if cached and cached[0] == total:
+        return cached[1]
+    if ftsSearchable(search):
+        # counted on the index alone, without touching rss_history
+        count = db.session.execute(db.text(
+            'SELECT count(*) FROM rss_history_fts WHERE rss_history_fts MATCH :match'),
+            {'match': ftsMatchQuery(search)}).scalar()
+    else:
+        query = historyLikeFilter(RSSHistory.query, search)
+        count = db.session.execute(db.select(db.func.count()).select_from(
+            query.with_entities(RSSHistory.id).limit(HISTORY_COUNT_CAP).subquery())).scalar()
+    cachePut(historyCounts, search, (total, count), size=64)
+    return count
+
+
 @app.route('/api/rsslogdata')
 @auth.login_required
 def rssHistoryData():
     query = RSSHistory.query
 
-    # search filter
-    search = request.args.get('search[value]')
-    if search:
-        query = query.filter(db.or_(
-            RSSHistory.title.like(f'%{search}%'),
-        ))
-    total_filtered = query.count()
-
     # sorting
     order = []
+    order_names = []
     i = 0
     while True:
         col_index = request.args.get(f'order[{i}][column]')
@@ -166,20 +359,68 @@ def rssHistoryData():
         if descending:
             col = col.desc()
         order.append(col)
+        order_names.append((col_name, descending))
         i += 1
-    if order:
-        query = query.order_by(*order)
+
+    # search filter, through the full-text index when there is one; without
+    # an explicit order the best matches come first, else the newest
+    search = (request.args.get('search[value]') or '').strip()
+    total = historyTotal()
+    total_filtered = historyFilteredCount(search, total) if search else total
 
     # pagination
-    start = request.args.get('start', type=int)
+    start = request.args.get('start', type=int) or 0
     length = request.args.get('length', type=int)
-    query = query.offset(start).limit(length)
+    if length is None or length < 0:
+        length = total_filtered
+
+    ranked = False
+    if search:
+        ranked = not order and ftsSearchable(search) and total_filtered <= HISTORY_RANK_MAX
+        query = historySearchFilter(query, search, total_filtered, total,
+                                    start + length, ranked=ranked)
+    if not order and not ranked:
+        order_names = [('addedon', True)]
+
+    if len(order_names) == 1 and order_names[0][0] == 'addedon':
+        # keyset pagination on (addedon, id): continue from the last row of the
+        # previous page instead of OFFSET, which scans all the skipped rows.
+        # A cursor is good only while the table is unchanged (total), rows
+        # inserted or deleted since then move the page boundaries
+        descending = order_names[0][1]
+        key = (search or '', descending)
+        cursor = cacheGet(historyCursors, key + (start,))
+        cursor = cursor[1] if cursor and cursor[0] == total else None
+        keycols = db.tuple_(RSSHistory.addedon, RSSHistory.id)
+        if cursor:
+            query = query.filter(keycols < cursor if descending else keycols > cursor)
+            offset, reverse = 0, False
+        elif not search and start > total_filtered // 2:
+            # deep page without a cursor: seek from the other end
+            offset, reverse = max(0, total_filtered - start - length), True
+            length = min(length, total_filtered - start)
+        else:
+            offset, reverse = start, False
+        if descending != reverse:
+            query = query.order_by(RSSHistory.addedon.desc(), RSSHistory.id.desc())
+        else:
+            query = query.order_by(RSSHistory.addedon, RSSHistory.id)
+        rows = query.offset(offset).limit(max(length, 0)).all()
+        if reverse:
+            rows.reverse()
+        if rows:
+            cachePut(historyCursors, key + (start + len(rows),),
+                     (total, (rows[-1].addedon, rows[-1].id)))
+    else:
+        if order:
+            query = query.order_by(*order, RSSHistory.id)
+        rows = query.offset(start).limit(length)
 
     # response
     return {
-        'data': [user.to_dict() for user in query],
+        'data': [user.to_dict() for user in rows],
         'recordsFiltered': total_filtered,
-        'recordsTotal': RSSHistory.query.count(),
+        'recordsTotal': total,
         'draw': request.args.get('draw', type=int),
     }
 
@@ -248,6 +489,8 @@ def rssNew():
     form = RSSTaskForm(request.form)
     if request.method == 'POST':
         form = RSSTaskForm(request.form)
+        if not form.validateRules():
+            return render_template('rssnew.html', form=form)
         task = RSSTask()
         task.rsslink = form.rsslink.data
         task.site = getSiteName(task.rsslink)
@@ -260,14 +503,17 @@ def rssNew():
         task.size_min = form.size_min.data
         task.size_max = form.size_max.data
         task.task_interval = form.task_interval.data
+        task.adaptive = form.adaptive.data
         task.qbcategory = form.qbcategory.data
         task.total_count = 0
         task.accept_count = 0
+        task.fetch_count = 0
+        task.notmodified_count = 0
         db.session.add(task)
         db.session.commit()
+        rssfilter.getTaskFilter(task)
 
-        job = scheduler.add_job(rssJob, 'interval', args=[
-                                task.id], minutes=task.task_interval, id=str(task.id))
+        notifyWorker()
         return redirect("/rsstasks")
 
     return render_template('rssnew.html', form=form)
@@ -278,10 +524,6 @@ def rssNew():
 def rssEdit(id):
     # task = RSSTask.query.get(id)
     task = db.session.get(RSSTask, id)
-    try:
-        scheduler.remove_job(str(task.id))
-    except:
-        pass
 
     form = RSSTaskForm(request.form)
     form.rsslink.data = task.rsslink
@@ -294,9 +536,12 @@ def rssEdit(id):
     form.size_min.data = task.size_min
     form.size_max.data = task.size_max
     form.task_interval.data = task.task_interval
+    form.adaptive.data = task.adaptive
 
     if request.method == 'POST':
         form = RSSTaskForm(request.form)
+        if not form.validateRules():
+            return render_template('rssnew.html', form=form)
         task.rsslink = form.rsslink.data
         task.site = getSiteName(task.rsslink)
         task.cookie = form.cookie.data
@@ -308,13 +553,19 @@ def rssEdit(id):
         task.size_min = form.size_min.data
         task.size_max = form.size_max.data
         task.task_interval = form.task_interval.data
+        task.adaptive = form.adaptive.data
+        task.current_interval = None
+        # the link may have changed, drop the old validators
+        task.etag = ''
+        task.last_modified = ''
         # task.total_count = 0
         # task.accept_count = 0
 
         db.session.commit()
+        rssfilter.invalidateTaskFilter(task.id)
+        rssfilter.getTaskFilter(task)
 
-        job = scheduler.add_job(rssJob, 'interval', args=[
-                                task.id], minutes=task.task_interval, id=str(task.id))
+        notifyWorker()
         return redirect("/rsstasks")
 
     return render_template('rssnew.html', form=form)
@@ -326,14 +577,15 @@ def apiRssDel():
     tid = request.args.get('taskid')
     deleted = True
     task = RSSTask.query.filter(RSSTask.id == tid).first()
-    try:
-        scheduler.remove_job(str(task.id))
-    except:
+    if not task:
         deleted = False
-        pass
-
-    db.session.delete(task)
-    db.session.commit()
+    else:
+        db.session.delete(task)
+        db.session.commit()
+        rssfilter.invalidateTaskFilter(task.id)
+        # the worker holding it drops the job on its next sync
+        lease.release(db.engine, [taskLease(task.id)], owner=None)
+        notifyWorker()
     # return redirect("/rsstasks")
     return json.dumps({'deleted': deleted}), 200, {'ContentType': 'application/json'}
 
@@ -356,33 +608,98 @@ def apiRssToggleActive():
     if task:
         if task.active == 0:
             task.active = 2
-            try:
-                scheduler.pause_job(str(task.id))
-            except:
-                pass
         else:
             task.active = 0
-            try:
-                scheduler.resume_job(str(task.id))
-            except:
-                pass
 
         # scheduler.print_jobs()
         db.session.commit()
+        notifyWorker()
 
     return json.dumps({'active': task.active}), 200, {'ContentType': 'application/json'}
 
 
+def localStats():
+    # what a worker publishes, in its JSON form (task ids as strings)
+    return json.loads(json.dumps({
+        'stages': metrics.snapshot(),
+        'rules': rssfilter.allRuleStats(),
+        'runner': taskRunner.metrics(),
+    }))
+
+
+def workerStats():
+    # the snapshots the workers published; a process running jobs itself
+    # uses its own current numbers instead of its last snapshot
+    snaps = workerstats.collect(db.engine, exclude=lease.WORKER_ID)
+    if RUN_WORKER:
+        snaps.append(localStats())
+    return snaps
+
+
+def mergeRunnerStats(snaps):
+    runner = {'workers': 0, 'queue_depth': 0, 'running': 0, 'oldest_wait': 0, 'tasks': {}}
+    for snap in snaps:
+        r = snap['runner']
+        for key in ('workers', 'queue_depth', 'running'):
+            runner[key] += r[key]
+        runner['oldest_wait'] = max(runner['oldest_wait'], r['oldest_wait'])
+        runner['tasks'].update(r['tasks'])
+    return runner
+
+
+@app.route('/api/rulestats')
+@auth.login_required
+def apiRuleStats():
+    # match timing of the compiled rules, per task id and rule
+    rules = {}
+    for snap in workerStats():
+        rules.update(snap['rules'])
+    return jsonify(rules)
+
+
+@app.route('/api/schedstats')
+@auth.login_required
+def apiSchedStats():
+    # worker pool queue depth and per task queue wait / run time
+    return jsonify(mergeRunnerStats(workerStats()))
+
+
+@app.route('/metrics')
+@auth.login_required
+def metricsText():
+    # Prometheus text format, summed over the worker processes
+    snaps = workerStats()
+    runner = mergeRunnerStats(snaps)
+    gauges = {
+        'worker_processes': ('Worker processes publishing metrics.', len(snaps)),
+        'queue_depth': ('Rss tasks waiting for a worker.', runner['queue_depth']),
+        'running_tasks': ('Rss tasks running.', runner['running']),
+        'oldest_wait_seconds': ('Wait of the oldest queued rss task.', runner['oldest_wait']),
+        'history_rows': ('Rows in rss_history.', historyTotal()),
+    }
+    histograms = metrics.mergeSnapshots([snap['stages'] for snap in snaps])
+    return metrics.render(gauges, histograms), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+
+@app.route('/stats')
+@auth.login_required
+def statsPage():
+    by = 'task' if request.args.get('by') == 'task' else 'site'
+    snaps = workerStats()
+    histograms = metrics.mergeSnapshots([snap['stages'] for snap in snaps])
+    return render_template('stats.html', rows=metrics.summary(by, histograms), by=by,
+                           stages=metrics.STAGES, runner=mergeRunnerStats(snaps))
+
+
 @app.route('/api/rssrunonce')
 @auth.login_required
 def apiRunRssNow():
     tid = request.args.get('taskid')
-    try:
-        job = scheduler.get_job(str(tid))
-        if job:
-            job.modify(next_run_time=datetime.now())
-    except:
-        pass
+    # last_update stays, it is the time of the last run
+    db.session.execute(db.update(RSSTask).where(RSSTask.id == tid).values(
+        run_requested=datetime.now(), last_update=RSSTask.last_update))
+    db.session.commit()
+    notifyWorker()
     return json.dumps({'success': True}), 200, {'ContentType': 'application/json'}
 
 
@@ -492,14 +809,6 @@ def logview():
 # --------------------------------------
 
 
-def tryFloat(fstr):
-    try:
-        f = float(fstr)
-    except:
-        f = 0.0
-    return f
-
-
 def tryint(instr):
     try:
         string_int = int(instr)
@@ -564,98 +873,264 @@ def genrSiteId(detailLink, imdbstr):
     return siteAbbrev + "_" + sid
 
 
-def addTorrent(dl_entry,  size_storage_space):
+def addTorrents(dl_entries, size_storage_space):
+    # all accepted torrents of a run share one disk space plan,
+    # returns a status code per entry
     if (not myconfig.CONFIG.qbServer):
-        return 400
+        return [400] * len(dl_entries)
 
-    if not validDownloadlink(dl_entry.downlink):
-        return 402
+    results = [201 if validDownloadlink(x.downlink) else 402 for x in dl_entries]
+    valid = [x for x, r in zip(dl_entries, results) if r == 201]
 
     if not myconfig.CONFIG.dryrun:
-        if not qbfunc.addQbitWithTag(dl_entry, size_storage_space):
-            return 301
+        added = iter(qbfunc.addQbitBatchWithTag(valid, size_storage_space) if valid else [])
+        results = [r if r != 201 or next(added) else 301 for r in results]
     else:
-        logger.info("   >> DRYRUN: " + dl_entry.title +
-                    "\n   >> " + dl_entry.siteid_str)
+        for dl_entry in valid:
+            logger.info("   >> DRYRUN: " + dl_entry.title +
+                        "\n   >> " + dl_entry.siteid_str)
+
+    return results
+
+
+class SeenCache:
+    # LRU of item guids / titles known to be in rss_history, so items seen
+    # in earlier runs skip the database entirely
+    def __init__(self, capacity=100000):
+        self.capacity = capacity
+        self.keys = OrderedDict()
+        self.lock = threading.Lock()
+
+    def contains(self, key):
+        with self.lock:
+            if key in self.keys:
+                self.keys.move_to_end(key)
+                return True
+        return False
+
+    def add(self, *keys):
+        with self.lock:
+            for key in keys:
+                if not key:
+                    continue
+                self.keys[key] = True
+                self.keys.move_to_end(key)
+            while len(self.keys) > self.capacity:
+                self.keys.popitem(last=False)
 
-    return 201
 
+seenCache = SeenCache()
+# keep well below SQLite's bound parameter limit
+HISTORY_LOOKUP_CHUNK = 400
 
-def existsInRssHistory(torname):
-    with app.app_context():
-        # exists = db.session.query(RSSHistory.id).filter_by(title=torname).first() is not None
-        exists = db.session.query(db.exists().where(
-            RSSHistory.title == torname)).scalar()
-    return exists
-
-
-def fetchInfoPage(pageUrl, pageCookie):
-    cookie = SimpleCookie()
-    cookie.load(pageCookie)
-    cookies = {k: v.value for k, v in cookie.items()}
-    headers = {
-        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.9",
-        'User-Agent':
-        "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/109.0.0.0 Safari/537.36 Edg/109.0.1518.78",
-        'Content-Type': 'text/html; charset=UTF-8'
-    }
 
-    try:
-        r = pyrequests.get(pageUrl, headers=headers,
-                           cookies=cookies, timeout=15)
-        # r.encoding = r.apparent_encoding
-        r.encoding = 'utf-8'
-    except:
-        return ''
-
-    return r.text
-
-
-def parseInfoPageIMDbval(doc):
-    imdbval = 0
-    m1 = re.search(r'IMDb.*?([0-9.]+)\s*/\s*10', doc, flags=re.I)
-    if m1:
-        imdbval = tryFloat(m1[1])
-    doubanval = 0
-    m2 = re.search(r'豆瓣评分.*?([0-9.]+)/10', doc, flags=re.I)
-    if m2:
-        doubanval = tryFloat(m2[1])
-    if imdbval < 1 and doubanval < 1:
-        ratelist = [x[1] for x in re.finditer(
-            r'Rating:.*?([0-9.]+)\s*/\s*10\s*from', doc, flags=re.I)]
-        if len(ratelist) >= 2:
-            doubanval = tryFloat(ratelist[0])
-            imdbval = tryFloat(ratelist[1])
-        elif len(ratelist) == 1:
-            # TODO: 不分辨douban/imdb了
-            doubanval = tryFloat(ratelist[0])
-            imdbval = doubanval
-            # rate1 = re.search(r'Rating:.*?([0-9.]+)\s*/\s*10\s*from', doc, flags=re.A)
-            # if rate1:
-            #     imdbval = tryFloat(rate1[1])
-        # print("   >> IMDb: %s, douban: %s" % (imdbval, doubanval))
-    return imdbval, doubanval
-
-
-def parseInfoPageIMDbId(doc):
-    imdbstr = ''
-    m1 = re.search(r'www\.imdb\.com\/title\/(tt\d+)', doc, flags=re.A)
-    if m1:
-        imdbstr = m1[1]
-    return imdbstr
+def normalizeGuid(item):
+    guid = getattr(item, 'id', '') or getattr(item, 'link', '') or ''
+    return remove_passkey_from_url(guid.strip())[:255]
+
+
+def isSeenItem(guid, title):
+    return seenCache.contains('g:' + guid) or seenCache.contains('t:' + title)
+
+
+def markSeenItem(guid, title):
+    seenCache.add('g:' + guid if guid else '', 't:' + title if title else '')
+
+
+seenKeysQuery = db.text('SELECT key FROM rss_seen WHERE key IN :keys').bindparams(
+    db.bindparam('keys', expanding=True))
+
+
+def lookupRssHistory(entries):
+    # one set-based query per chunk instead of one EXISTS per item; guid for
+    # rows written since guids are stored, title for the older rows
+    pending = [(normalizeGuid(x), x.title) for x in entries
+               if hasattr(x, 'title') and not isSeenItem(normalizeGuid(x), x.title)]
+    for i in range(0, len(pending), HISTORY_LOOKUP_CHUNK):
+        chunk = pending[i:i + HISTORY_LOOKUP_CHUNK]
+        guids = [g for g, _ in chunk if g]
+        titles = [t for _, t in chunk]
+        query = db.union(
+            db.select(RSSHistory.guid, RSSHistory.title).where(
+                RSSHistory.guid.in_(guids)),
+            db.select(RSSHistory.guid, RSSHistory.title).where(
+                RSSHistory.title.in_(titles)))
+        for guid, title in db.session.execute(query):
+            markSeenItem(guid, title)
+        # items whose history rows were archived by the retention job
+        keys = {}
+        for guid, title in chunk:
+            if not isSeenItem(guid, title):
+                for key in retention.itemSeenKeys(guid, title):
+                    keys[key] = (guid, title)
+        if keys:
+            for key, in db.session.execute(seenKeysQuery, {'keys': list(keys)}):
+                markSeenItem(*keys[key])
+
 
 def remove_passkey_from_url(url):
     # 使用正则表达式匹配并去除 passkey 参数及其值
     return re.sub(r'&passkey=[^&]*', '', url)
 
-def processRssFeeds(rsstask):
-    feed = feedparser.parse(rsstask.rsslink)
-    rssFeedSum = 0
-    rssAccept = 0
+def fetchRssFeed(rsstask):
+    # conditional GET: send If-None-Match / If-Modified-Since with the
+    # validators saved from the last full fetch
+    if myconfig.CONFIG.streamParse:
+        try:
+            feed = feedstream.openFeed(rsstask.rsslink,
+                                       etag=rsstask.etag or None,
+                                       modified=rsstask.last_modified or None)
+        except Exception as e:
+            # the error text holds the feed url with its passkey
+            logger.error(f'RSS {rsstask.site} - fetch failed: {type(e).__name__}, '
+                         f'{infopage.normalizeInfoLink(rsstask.rsslink)}')
+            return feedparser.FeedParserDict(entries=[])
+    else:
+        feed = feedparser.parse(rsstask.rsslink,
+                                etag=rsstask.etag or None,
+                                modified=rsstask.last_modified or None)
+    if feed.get('status') == 304:
+        rsstask.notmodified_count = (rsstask.notmodified_count or 0) + 1
+        return None
+
+    rsstask.fetch_count = (rsstask.fetch_count or 0) + 1
+    if feed.get('status') == 200:
+        rsstask.etag = feed.get('etag', '')
+        rsstask.last_modified = feed.get('modified', '')
+    return feed
+
+
+# a failed commit of a run (e.g. the database locked past busy_timeout) is
+# tried this many times
+SAVE_ATTEMPTS = 3
+# task columns a run updates, committed together with its history rows
+RUN_TASK_FIELDS = ('accept_count', 'fetch_count', 'notmodified_count', 'etag', 'last_modified')
+
+
+def saveRssRun(records, tasks=()):
+    # one bulk insert and one commit per run; OR IGNORE drops decisions
+    # another run of the task recorded meanwhile (ux_rss_history_guid_tid).
+    # The items count as seen only once committed: when every attempt fails
+    # the error is raised and the next run decides them again
+    columns = [c.name for c in RSSHistory.__table__.columns if c.name != 'id']
+    rows = [{c: getattr(r, c) for c in columns} for r in records]
+    # a rollback expires the tasks and drops their run counters and
+    # validators, every attempt sets them again
+    taskValues = [(t, {f: getattr(t, f) for f in RUN_TASK_FIELDS}) for t in tasks]
+    for attempt in range(1, SAVE_ATTEMPTS + 1):
+        try:
+            for task, values in taskValues:
+                for field, value in values.items():
+                    setattr(task, field, value)
+            if rows:
+                db.session.execute(
+                    db.insert(RSSHistory).prefix_with('OR IGNORE'), rows)
+            db.session.commit()
+            break
+        except Exception as e:
+            db.session.rollback()
+            # the driver's error only: the statement parameters hold the
+            # download links with their passkeys
+            err = getattr(e, 'orig', None) or e
+            if attempt == SAVE_ATTEMPTS:
+                logger.error(f'Fail to save rss history: {err}')
+                raise
+            logger.warning(f'Fail to save rss history, attempt {attempt}: {err}')
+            time.sleep(attempt)
+    for r in records:
+        markSeenItem(r.guid, r.title)
+
+
+# window in which a run of one task also counts as the run of the other
+# tasks on the same feed link
+FEED_SHARE_WINDOW = 60
+feedRuns = {}
+feedRunsLock = threading.Lock()
+
+
+# entries are checked against history this many at a time, so a streamed
+# feed is read no further than needed
+FEED_LOOKUP_BATCH = 50
+
+
+def feedEntries(feed, timer):
+    batch = []
+    entries = iter(feed.entries)
+    while True:
+        with timer.stage('parse'):
+            item = next(entries, None)
+        if item is not None:
+            batch.append(item)
+        if batch and (item is None or len(batch) >= FEED_LOOKUP_BATCH):
+            with timer.stage('dedup'):
+                lookupRssHistory(batch)
+            yield from batch
+            batch = []
+        if item is None:
+            return
+
+
+def claimFeedRun(rsslink):
+    # False when a task on this link ran within FEED_SHARE_WINDOW
+    now = time.monotonic()
+    with feedRunsLock:
+        last = feedRuns.get(rsslink)
+        if last and now - last < FEED_SHARE_WINDOW:
+            return False
+        feedRuns[rsslink] = now
+        return True
+
+
+def feedSubscribers(rsstask):
+    # active tasks on the same link, in id order so it does not depend on
+    # which task's job fired which task sees an item first
+    tasks = RSSTask.query.filter(RSSTask.rsslink == rsstask.rsslink,
+                                 db.or_(RSSTask.active != 2, RSSTask.id == rsstask.id)
+                                 ).order_by(RSSTask.id).all()
+    subscribers = []
+    for task in tasks:
+        try:
+            subscribers.append((task, rssfilter.getTaskFilter(task)))
+        except (re.error, ValueError) as e:
+            logger.error(f'RSS {task.site} - invalid rule, task skipped: {e}')
+    return subscribers
+
 
-    size_storage_space = qbfunc.get_free_space()
-    for item in feed.entries:
-        rssFeedSum += 1
+def processRssFeeds(rsstask):
+    # one fetch and parse of the feed for every task on its link; the new
+    # items go through the rules of each task, the first task accepting an
+    # item gets it
+    if not claimFeedRun(rsstask.rsslink):
+        logger.info(f'RSS {rsstask.site} - Fetched with another task on the same link, skip')
+        return None
+    subscribers = feedSubscribers(rsstask)
+    if not subscribers:
+        return None
+
+    timer = metrics.RunTimer(rsstask.id, rsstask.site)
+    try:
+        return processFeedItems(rsstask, subscribers, timer)
+    finally:
+        timer.finish()
+
+
+def processFeedItems(rsstask, subscribers, timer):
+    with timer.stage('fetch'):
+        feed = fetchRssFeed(rsstask)
+    for task, _ in subscribers:
+        if task is not rsstask:
+            task.etag = rsstask.etag
+            task.last_modified = rsstask.last_modified
+    if feed is None:
+        db.session.commit()
+        logger.info(f'RSS {rsstask.site} - Not modified ({datetime.now().strftime("%H:%M:%S")})')
+        return 0
+
+    items = []
+    # items of this run, marked seen by saveRssRun once committed
+    runKeys = set()
+    known = 0
+    for item in feedEntries(feed, timer):
         if not hasattr(item, 'id'):
             logger.info('RSS item: No id')
             continue
@@ -672,154 +1147,384 @@ def processRssFeeds(rsstask):
             logger.info('RSS item:  No download link')
             continue
 
-        if existsInRssHistory(item.title):
+        guid = normalizeGuid(item)
+        if isSeenItem(guid, item.title) or 'g:' + guid in runKeys or 't:' + item.title in runKeys:
             # print("   >> exists in rss history, skip")
             # logger.info("   >> Skip: EXISTS" )
+            known += 1
+            if myconfig.CONFIG.stopAfterKnown and known >= myconfig.CONFIG.stopAfterKnown:
+                # newest first: the rest of the feed is older than this run of known items
+                break
             continue
-
-        size_item = tryint(item.links[1]['length'])
-        dbrssitem = RSSHistory(site=rsstask.site,
-                               tid=rsstask.id,
-                               title=item.title,
-                               infoLink=item.link,
-                               downloadLink=item.links[1]['href'],
-                               size=size_item)
-
-        db.session.add(dbrssitem)
-        db.session.commit()
-
-        size_gb = size_item / 1024 / 1024 / 1024
-        logger.info(f"{rssFeedSum}: {item.title} ({humanSize(size_item)})")
-
-        if (size_gb < rsstask.size_min) or (size_gb > rsstask.size_max):
-            dbrssitem.reason = 'SIZE_MIN_MAX'
-            db.session.commit()
-            logger.info("   >> Skip: SIZE_MIN_MAX " )
-            continue
-
-        if rsstask.title_regex:
-            if not re.search(rsstask.title_regex, item.title, re.I):
-                dbrssitem.reason = 'TITLE_REGEX'
-                db.session.commit()
-                logger.info("   >> Skip: TITLE_REGEX " )
-                continue
-
-        if rsstask.title_not_regex:
-            if re.search(rsstask.title_not_regex, item.title, re.I):
-                dbrssitem.reason = 'TITLE_NOT_REGEX'
-                db.session.commit()
-                logger.info("   >> Skip: TITLE_NOT_REGEX " )
+        known = 0
+        runKeys.update(('g:' + guid, 't:' + item.title))
+        items.append((guid, item))
+    if hasattr(feed, 'close'):
+        feed.close()
+
+    # decisions are kept in memory, one history row per item and task, and
+    # written in one transaction at the end of the run, also when the run is
+    # interrupted by an exception
+    records = {}
+    try:
+        for task, taskfilter in subscribers:
+            if task is rsstask:
+                filterRssItems(task, taskfilter, items, records, timer)
+            else:
+                tasktimer = metrics.RunTimer(task.id, task.site)
+                filterRssItems(task, taskfilter, items, records, tasktimer)
+                tasktimer.finish(run=False)
+    finally:
+        with timer.stage('db_commit'):
+            saveRssRun([r for rows in records.values() for r in rows],
+                       [task for task, _ in subscribers])
+
+    # number of items not seen before
+    return len(items)
+
+
+def filterRssItems(rsstask, taskfilter, items, records, timer):
+    # records: guid -> RSSHistory rows of this run, shared by the tasks of a
+    # feed. Every task records its own decision on an item, items accepted
+    # by a task before this one are left to that task.
+    rssFeedSum = 0
+    rssAccept = 0
+    survivors = []
+    candidates = []
+    try:
+        for guid, item in items:
+            rows = records.setdefault(guid, [])
+            if any(r.accept >= 2 for r in rows):
+                # accepted by a task before this one
                 continue
-
-        imdbstr = ''
-        if rsstask.cookie:
-            # Means: will dl wihout cookie, but no dl if cookie is wrong
-            doc = fetchInfoPage(item.link, rsstask.cookie)
-            if not doc:
-                dbrssitem.reason = 'Fetch info page failed'
-                db.session.commit()
-                logger.info("   >> Skip: Fetch info page failed" )
+            rssFeedSum += 1
+
+            size_item = tryint(item.links[1]['length'])
+            dbrssitem = RSSHistory(site=rsstask.site,
+                                   tid=rsstask.id,
+                                   title=item.title,
+                                   guid=guid,
+                                   infoLink=item.link,
+                                   downloadLink=item.links[1]['href'],
+                                   size=size_item,
+                                   accept=0,
+                                   addedon=datetime.now())
+            rows.append(dbrssitem)
+
+            logger.info(f"{rssFeedSum}: {item.title} ({humanSize(size_item)})")
+
+            # size and title rules, before any info page is fetched
+            with timer.stage('title_filter'):
+                reason = taskfilter.titleReason(item.title, size_item)
+            if reason:
+                dbrssitem.reason = reason
+                logger.info(f"   >> Skip: {reason} " )
                 continue
-            imdbstr = parseInfoPageIMDbId(doc)
-            dbrssitem.imdbstr = imdbstr
-            db.session.commit()
 
-            if rsstask.info_regex:
-                if not re.search(rsstask.info_regex, doc, flags=re.A):
-                    dbrssitem.reason = 'INFO_REGEX'
-                    db.session.commit()
-                    continue
-            if rsstask.info_not_regex:
-                if re.search(rsstask.info_not_regex, doc, flags=re.A):
-                    dbrssitem.reason = 'INFO_NOT_REGEX'
-                    db.session.commit()
-                    logger.info("   >> Skip: INFO_NOT_REGEX" )
+            survivors.append((item, dbrssitem))
+
+        # info pages of the items that passed the cheap filters, fetched
+        # concurrently; the decisions below run in feed order as before
+        pages = {}
+        if rsstask.cookie and survivors:
+            with timer.stage('info_pages'):
+                # downloads stop once the fields the rules read are found
+                needs = infopage.PageNeeds(rsstask.min_imdb, taskfilter.regex('info_regex'),
+                                           taskfilter.regex('info_not_regex'))
+                pages = infopage.fetchInfoPages(
+                    [item.link for item, _ in survivors], rsstask.cookie,
+                    task=rsstask.id, site=rsstask.site, needs=needs)
+
+        for item, dbrssitem in survivors:
+            imdbstr = ''
+            if rsstask.cookie:
+                # Means: will dl wihout cookie, but no dl if cookie is wrong
+                page = pages.get(item.link)
+                if not page:
+                    dbrssitem.reason = 'Fetch info page failed'
+                    logger.info(f"   >> Skip: Fetch info page failed, {item.title}" )
                     continue
-            if rsstask.min_imdb:
-                imdbval, doubanval = parseInfoPageIMDbval(doc)
-                if (imdbval < rsstask.min_imdb) and (doubanval < rsstask.min_imdb):
-                    # print("   >> MIN_IMDb not match")
-                    dbrssitem.reason = "IMDb: %s, douban: %s" % (
-                        imdbval, doubanval)
-                    db.session.commit()
-                    logger.info("   >> Skip: MIN_IMDb" )
+                imdbstr = page.imdbstr
+                dbrssitem.imdbstr = imdbstr
+
+                # info_regex, info_not_regex and min_imdb
+                with timer.stage('info_filter'):
+                    reason = taskfilter.infoReason(page)
+                if reason:
+                    dbrssitem.reason = reason
+                    logger.info(f"   >> Skip: {reason}, {item.title}" )
                     continue
 
-        siteIdStr = genrSiteId(item.link, imdbstr)
-
-        rssDownloadLink = item.links[1]['href']
-        dbrssitem.accept = 2
-
-        # if checkMediaDbNameDupe(item.title):
-        #     dbrssitem.reason = "Name dupe"
-        #     db.session.commit()
-        #     continue
-
-        # r = checkMediaDbTMDbDupe(item.title, imdbstr)
-        # if r != 201:
-        #     dbrssitem.reason = 'TMDb dupe'
-        #     db.session.commit()
-        #     continue
-        logger.info(f'   >> ({humanSize(int(dbrssitem.size))}), {remove_passkey_from_url(rssDownloadLink)}')
-        # logger.info("   >> Entry: " + dl_entry.siteid_str)
-
-        qbcat = rsstask.qbcategory if rsstask.qbcategory else ''
-        dl_entry = qbfunc.DownloadEntry()
-        dl_entry.title = item.title
-        dl_entry.size = tryint(item.links[1]['length'])
-        dl_entry.downlink = rssDownloadLink.strip()
-        dl_entry.imdb = imdbstr
-        dl_entry.siteid_str = siteIdStr
-        dl_entry.label = qbcat
-
-
-        r = addTorrent(dl_entry, size_storage_space)
-        if r == 201:
-            # Downloaded
-            size_storage_space -=  dl_entry.size
-            dbrssitem.accept = 3
-            rssAccept += 1
-        elif r == 301:
-            dbrssitem.reason = 'disk space'
-        else:
-            dbrssitem.reason = 'qbit'
+            siteIdStr = genrSiteId(item.link, imdbstr)
+
+            rssDownloadLink = item.links[1]['href']
+            dbrssitem.accept = 2
+
+            # if checkMediaDbNameDupe(item.title):
+            #     dbrssitem.reason = "Name dupe"
+            #     db.session.commit()
+            #     continue
+
+            # r = checkMediaDbTMDbDupe(item.title, imdbstr)
+            # if r != 201:
+            #     dbrssitem.reason = 'TMDb dupe'
+            #     db.session.commit()
+            #     continue
+            logger.info(f'   >> ({humanSize(int(dbrssitem.size))}), {remove_passkey_from_url(rssDownloadLink)}')
+            # logger.info("   >> Entry: " + dl_entry.siteid_str)
+
+            qbcat = rsstask.qbcategory if rsstask.qbcategory else ''
+            dl_entry = qbfunc.DownloadEntry()
+            dl_entry.title = item.title
+            dl_entry.size = tryint(item.links[1]['length'])
+            dl_entry.downlink = rssDownloadLink.strip()
+            dl_entry.imdb = imdbstr
+            dl_entry.siteid_str = siteIdStr
+            dl_entry.label = qbcat
+            candidates.append((dl_entry, dbrssitem))
+
+        if candidates:
+            with timer.stage('free_space'):
+                size_storage_space = qbfunc.get_free_space()
+            with timer.stage('qbit_add'):
+                results = addTorrents([x for x, _ in candidates], size_storage_space)
+            for (dl_entry, dbrssitem), r in zip(candidates, results):
+                if r == 201:
+                    # Downloaded
+                    dbrssitem.accept = 3
+                    rssAccept += 1
+                elif r == 301:
+                    dbrssitem.reason = 'disk space'
+                else:
+                    dbrssitem.reason = 'qbit'
+    finally:
+        rsstask.accept_count += rssAccept
 
-        db.session.commit()
+    logger.info(f'RSS {rsstask.site} - Total: {rssFeedSum}, Accepted: {rssAccept} ({datetime.now().strftime("%H:%M:%S")})')
 
-    rsstask.accept_count += rssAccept
-    db.session.commit()
 
-    logger.info(f'RSS {rsstask.site} - Total: {rssFeedSum}, Accepted: {rssAccept} ({datetime.now().strftime("%H:%M:%S")})')
+def runRssTask(id):
+    with app.app_context():
+        task = RSSTask.query.filter(RSSTask.id == id).first()
+        if task:
+            # print('Runing task: ' + task.rsslink)
+            newItems = processRssFeeds(task)
+            if task.adaptive and newItems is not None:
+                rescheduleAdaptive(task, newItems)
+
 
+taskRunner = taskrunner.TaskRunner(runRssTask)
 
 
 def rssJob(id):
+    # scheduler job: queue the task for the worker pool, serialized per site
     with app.app_context():
         task = RSSTask.query.filter(RSSTask.id == id).first()
         if task:
-            # print('Runing task: ' + task.rsslink)
-            processRssFeeds(task)
+            taskRunner.submit(task.id, urlparse(task.rsslink).netloc or task.site)
+
+
+def taskInterval(task):
+    # minutes between runs
+    if task.adaptive and task.current_interval:
+        return task.current_interval
+    return task.task_interval
+
+
+def jobJitter(interval):
+    return min(myconfig.CONFIG.jobJitter, interval // 2)
+
+
+def addRssJob(task, delay=None):
+    # replaces the task's job; the first run is staggered by a hash of the
+    # link so tasks added together do not fire together, and every run gets
+    # a random jitter
+    interval = int(taskInterval(task) * 60)
+    stagger = zlib.crc32(task.rsslink.encode()) % max(1, interval)
+    first = datetime.now() + timedelta(seconds=(delay if delay is not None else interval) + stagger)
+    return scheduler.add_job(rssJob, 'interval', args=[task.id],
+                             seconds=interval,
+                             jitter=jobJitter(interval),
+                             next_run_time=first,
+                             id=str(task.id), replace_existing=True)
+
 
+# adaptive interval aims at this many new items per run
+ADAPTIVE_ITEMS_PER_RUN = 2
 
-def startApsScheduler():
+
+def adaptiveInterval(task, newItems):
+    # minutes until the next run: nothing new doubles the interval, else it
+    # follows the arrival rate of the task's items in rss_history
+    lo, hi = myconfig.CONFIG.adaptiveMin, myconfig.CONFIG.adaptiveMax
+    current = taskInterval(task)
+    if not newItems:
+        return max(lo, min(hi, current * 2))
+    window = max(60, current * 4)
+    arrived = db.session.query(db.func.count(RSSHistory.id)).filter(
+        RSSHistory.tid == task.id,
+        RSSHistory.addedon >= datetime.now() - timedelta(minutes=window)).scalar()
+    rate = max(arrived, newItems) / window
+    return max(lo, min(hi, ADAPTIVE_ITEMS_PER_RUN / rate))
+
+
+def rescheduleAdaptive(task, newItems):
+    interval = adaptiveInterval(task, newItems)
+    if task.current_interval and abs(interval - task.current_interval) < 0.1:
+        return
+    task.current_interval = interval
+    db.session.commit()
+    job = scheduler.get_job(str(task.id))
+    # a paused job stays paused, reschedule_job would resume it
+    if job and job.next_run_time:
+        seconds = int(interval * 60)
+        scheduler.reschedule_job(str(task.id), trigger='interval',
+                                 seconds=seconds, jitter=jobJitter(seconds))
+    logger.info(f'RSS {task.site} - {newItems} new, next run in {interval:.1f} min')
+
+
+def historyMaintenanceJob():
     with app.app_context():
-        tasks = RSSTask.query
+        try:
+            retention.archiveHistory(db.engine, myconfig.CONFIG.archiveDir,
+                                     myconfig.CONFIG.keepRejectedDays,
+                                     myconfig.CONFIG.keepAcceptedDays)
+            retention.compactDatabase(db.engine)
+        except Exception as e:
+            logger.error(f'History maintenance failed: {e}')
+
+
+# seconds between the syncs of a worker's jobs with the rss_task table
+JOB_SYNC_INTERVAL = 15
+# this process runs rss jobs (--worker, or both web and worker)
+RUN_WORKER = False
+jobSignatures = {}
+jobSyncLock = threading.Lock()
+jobsSynced = False
+
+
+def taskLease(tid):
+    return f'task:{tid}'
+
+
+def jobSignature(task):
+    # a change of these replaces the job; other edits are read at run time
+    return (task.rsslink, task.task_interval, bool(task.adaptive))
+
+
+def claimTaskLeases(tasks):
+    # renews this worker's leases and takes free ones up to its share of
+    # the tasks; over its share (another worker joined) it lets the excess
+    # go, the other workers pick them up on their next sync
+    lease.acquire(db.engine, [lease.WORKER_LEASE])
+    holders = lease.holders(db.engine)
+    workers = sum(1 for name in holders if name.startswith('worker:'))
+    names = [taskLease(t.id) for t in tasks]
+    share = math.ceil(len(names) / max(1, workers))
+    mine = [n for n in names if holders.get(n) == lease.WORKER_ID]
+    lease.release(db.engine, mine[share:])
+    free = [n for n in names if n not in holders][:share - len(mine[:share])]
+    return lease.acquire(db.engine, mine[:share] + free + ['maintenance'])
+
+
+def notifyWorker():
+    # a worker in this process applies the change now, other workers on
+    # their next sync
+    if RUN_WORKER:
+        syncRssJobs()
+
+
+def syncRssJobs():
+    # worker side of the web / worker split: schedule the tasks this worker
+    # holds the lease of, drop the jobs of tasks lost or deleted, apply
+    # pause / resume and run-now requests made in the web process
+    global jobsSynced
+    with jobSyncLock, app.app_context():
+        if myconfig.reloadConfig(ARGS.config):
+            logger.info(f'Config reloaded: {ARGS.config}')
+        try:
+            tasks = RSSTask.query.all()
+            held = claimTaskLeases(tasks)
+        except Exception as e:
+            logger.error(f'Job sync failed: {e}')
+            return
+        delay = None if jobsSynced else myconfig.CONFIG.startDelay * 60
+        jobsSynced = True
+        requested = []
         for t in tasks:
-            if not scheduler.get_job(str(t.id)):
-                logger.info(f"Start rss task: {remove_passkey_from_url(t.rsslink)}")
-                job = scheduler.add_job(rssJob, 'interval',
-                                        args=[t.id],
-                                        minutes=t.task_interval,
-                                        next_run_time=datetime.now()+timedelta(minutes=15),
-                                        id=str(t.id))
-                if ARGS.no_rss or t.active == 2:
-                    job.pause()
+            job = scheduler.get_job(str(t.id))
+            if taskLease(t.id) not in held:
+                if job:
+                    logger.info(f'Task {t.id} went to another worker')
+                    job.remove()
+                    jobSignatures.pop(t.id, None)
+                continue
+            if not job or jobSignatures.get(t.id) != jobSignature(t):
+                if not job:
+                    logger.info(f"Start rss task: {remove_passkey_from_url(t.rsslink)}")
+                job = addRssJob(t, delay=delay if not job else None)
+                jobSignatures[t.id] = jobSignature(t)
+            paused = ARGS.no_rss or t.active == 2
+            if paused and job.next_run_time:
+                job.pause()
+            elif not paused and not job.next_run_time:
+                job.resume()
+            if t.run_requested:
+                requested.append(t)
+
+        taskIds = {str(t.id) for t in tasks}
+        for job in scheduler.get_jobs():
+            if job.id.isdigit() and job.id not in taskIds:
+                job.remove()
+                jobSignatures.pop(int(job.id), None)
+                taskRunner.forget(int(job.id))
+
+        if requested:
+            db.session.execute(db.update(RSSTask).where(
+                RSSTask.id.in_([t.id for t in requested])).values(
+                run_requested=None, last_update=RSSTask.last_update))
+            db.session.commit()
+            for t in requested:
+                taskRunner.submit(t.id, urlparse(t.rsslink).netloc or t.site)
+
+        maintenance = scheduler.get_job('history_maintenance')
+        if 'maintenance' in held and not maintenance:
+            scheduler.add_job(historyMaintenanceJob, 'interval', hours=24,
+                              next_run_time=datetime.now()+timedelta(minutes=30),
+                              id='history_maintenance')
+        elif 'maintenance' not in held and maintenance:
+            maintenance.remove()
 
+        try:
+            workerstats.publish(db.engine, localStats())
+        except Exception as e:
+            logger.error(f'Worker stats not published: {e}')
+
+
+def startWorker():
+    global RUN_WORKER
+    RUN_WORKER = True
+    taskRunner.start(myconfig.CONFIG.taskWorkers)
     scheduler.start()
+    syncRssJobs()
+    scheduler.add_job(syncRssJobs, 'interval', seconds=JOB_SYNC_INTERVAL,
+                      id='sync_jobs', replace_existing=True)
     scheduler.print_jobs()
+    atexit.register(stopWorker)
+    # SIGTERM exits through atexit too, releasing the leases
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    logger.info(f'Worker {lease.WORKER_ID} started')
+
+
+def stopWorker():
+    # hand the tasks over to the other workers right away
+    scheduler.shutdown(wait=False)
+    with app.app_context():
+        lease.release(db.engine)
+        workerstats.remove(db.engine)
 
 
-def loadArgs():
+def loadArgs(argv=None):
     parser = argparse.ArgumentParser(
         description='Tor Rss.')
     parser.add_argument('-C', '--config', help='config file.')
@@ -827,13 +1532,51 @@ def loadArgs():
                         action='store_true', help='init pasword.')
     parser.add_argument('--no-rss',
                         action='store_true', help='do not start rss tasks')
+    parser.add_argument('--debug', action='store_true',
+                        help='serve with the Flask development server, debug on')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--web', action='store_true',
+                      help='web UI only, rss tasks run in worker processes')
+    mode.add_argument('--worker', action='store_true',
+                      help='run rss tasks only, no web UI; several workers share the tasks')
 
     global ARGS
-    ARGS = parser.parse_args()
+    ARGS = parser.parse_args(argv)
     if not ARGS.config:
         ARGS.config = os.path.join(os.path.dirname(__file__), 'config.ini')
 
 
+def setupLogging(logFile=True):
+    import logging
+    log = logging.getLogger('werkzeug')
+    log.setLevel(logging.ERROR)
+    log.disabled = True
+
+    logger.remove()
+    formatstr = "{time:YYYY-MM-DD HH:mm:ss} | <level>{level: <8}</level> | - <level>{message}</level>"
+    logger.add(sys.stdout, format=formatstr)
+    if logFile:
+        logger.add(LOG_FILE_NAME, format=formatstr, rotation="500 MB")
+    # logger.add(sys.stdout, format="<green>{time:YYYY-MM-DD at HH:mm:ss}</green> | <level>{message}</level>")
+
+
+def createApp(configFile=None):
+    # WSGI app factory for a production server, web UI only: the rss jobs
+    # run in `python app.py --worker`, not once per server worker
+    #   gunicorn -w 2 --threads 4 -b 0.0.0.0:5009 'app:createApp()'
+    #   waitress-serve --port 5009 --threads 8 --call app:createApp
+    # the config file: configFile, TORRSS_CONFIG, or config.ini
+    configFile = configFile or os.environ.get('TORRSS_CONFIG')
+    loadArgs(['--web'] + (['-C', configFile] if configFile else []))
+    # several server processes, only the worker writes torrss.log
+    setupLogging(logFile=False)
+    initDatabase()
+    myconfig.readConfig(ARGS.config)
+    if not myconfig.CONFIG.basicAuthUser or not myconfig.CONFIG.basicAuthPass:
+        raise RuntimeError(f'set user/pasword in {ARGS.config} or use "python app.py -G"')
+    return app
+
+
 def main():
     loadArgs()
     initDatabase()
@@ -841,23 +1584,27 @@ def main():
     if ARGS.init_password:
         myconfig.generatePassword(ARGS.config)
         return
-    if not myconfig.CONFIG.basicAuthUser or not myconfig.CONFIG.basicAuthPass:
+    if not ARGS.worker and (not myconfig.CONFIG.basicAuthUser or not myconfig.CONFIG.basicAuthPass):
         print('set user/pasword in config.ini or use "-G" argument')
         return
-    startApsScheduler()
+    if not ARGS.web:
+        startWorker()
+    if ARGS.worker:
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+        return
+    cfg = myconfig.CONFIG
+    if ARGS.debug:
 # https://stackoverflow.com/questions/14874782/apscheduler-in-flask-executes-twice
-    app.run(host='0.0.0.0', port=5009, debug=True, use_reloader=False)
+        app.run(host=cfg.webHost, port=cfg.webPort, debug=True, use_reloader=False)
+    else:
+        logger.info(f'Serving on http://{cfg.webHost}:{cfg.webPort}, {cfg.webThreads} threads')
+        waitress.serve(app, host=cfg.webHost, port=cfg.webPort, threads=cfg.webThreads)
 
 
 if __name__ == '__main__':
-    import logging
-    log = logging.getLogger('werkzeug')
-    log.setLevel(logging.ERROR)
-    log.disabled = True
-
-    logger.remove()
-    formatstr = "{time:YYYY-MM-DD HH:mm:ss} | <level>{level: <8}</level> | - <level>{message}</level>"
-    logger.add(sys.stdout, format=formatstr)
-    logger.add(LOG_FILE_NAME, format=formatstr, rotation="500 MB")
-    # logger.add(sys.stdout, format="<green>{time:YYYY-MM-DD at HH:mm:ss}</green> | <level>{message}</level>")
+    setupLogging()
     main()
@@ -0,0 +1,189 @@
+import re
+import json
+import time
+import threading
+import http.server
+from urllib.parse import urlparse, parse_qsl
+
+# Local stand-ins for the benchmark: a tracker serving a synthetic
+# newest-first rss feed and info pages, and the part of the qBittorrent
+# WebUI API v2 that qbfunc uses. Both count the requests they serve.
+
+GB = 1024 ** 3
+SOURCES = ['BluRay', 'WEB-DL', 'Remux', 'HDTV']
+GROUPS = ['FRDS', 'CMCT', 'HDS', 'WiKi', 'CHD']
+
+
+def itemTitle(i):
+    return f'Bench.Movie.{i}.{1990 + i % 34}.{1080 if i % 3 else 2160}p.{SOURCES[i % 4]}.x264-{GROUPS[i % 5]}'
+
+
+def itemSize(i):
+    return (i % 40 + 1) * GB
+
+
+def rssFeed(baseUrl, top, count):
+    # items top, top-1, ... like a tracker feed, newest first
+    items = []
+    for i in range(top, max(0, top - count), -1):
+        items.append(
+            f'<item><title>{itemTitle(i)}</title>'
+            f'<link>{baseUrl}/details.php?id={i}&amp;hit=1</link>'
+            f'<guid isPermaLink="false">bench-{i}</guid>'
+            f'<enclosure url="{baseUrl}/download.php?id={i}&amp;passkey=bench" '
+            f'length="{itemSize(i)}" type="application/x-bittorrent"/></item>')
+    return ('<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel>'
+            f'<title>bench</title><link>{baseUrl}</link>{"".join(items)}</channel></rss>').encode()
+
+
+def infoPage(i, padding):
+    return (f'<html><body><h1>{itemTitle(i)}</h1>'
+            f'<div id="kdescr">{"DIY 中字" if i % 2 else "WEB"} '
+            f'<a href="https://www.imdb.com/title/tt{1000000 + i}/">imdb</a> '
+            f'IMDb评分 {5 + i % 5}.{i % 10}/10 from 1000 users 豆瓣评分 {6 + i % 4}.5/10'
+            f'{"x" * padding}</div></body></html>').encode()
+
+
+class QuietServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients hang up early on purpose, e.g. a feed read only up to the
+        # known items
+        pass
+
+
+class Server:
+    def __init__(self, handler):
+        self.httpd = QuietServer(('127.0.0.1', 0), handler)
+        self.httpd.site = self
+        self.lock = threading.Lock()
+        self.calls = {}
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.httpd.server_address[1]}'
+
+    def count(self, kind):
+        with self.lock:
+            self.calls[kind] = self.calls.get(kind, 0) + 1
+
+    def takeCalls(self):
+        with self.lock:
+            calls, self.calls = self.calls, {}
+        return calls
+
+    def close(self):
+        self.httpd.shutdown()
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are separate writes, no delayed-ACK stalls
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, body=b'', code=200, ctype='text/plain', headers=None):
+        if isinstance(body, (dict, list)):
+            body, ctype = json.dumps(body).encode(), 'application/json'
+        elif isinstance(body, str):
+            body = body.encode()
+        self.send_response(code)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class TrackerHandler(Handler):
+    def do_GET(self):
+        site = self.server.site
+        path = urlparse(self.path)
+        query = dict(parse_qsl(path.query))
+        if path.path == '/rss':
+            site.count('feed')
+            etag = f'"{site.top}"'
+            if self.headers.get('If-None-Match') == etag:
+                return self.send(code=304)
+            return self.send(rssFeed(site.url, site.top, site.feedItems),
+                             ctype='application/rss+xml', headers={'ETag': etag})
+        if path.path == '/details.php':
+            site.count('info')
+            if site.latency:
+                time.sleep(site.latency)
+            return self.send(infoPage(int(query.get('id', 0)), site.padding),
+                             ctype='text/html; charset=utf-8')
+        return self.send(code=404)
+
+
+class FakeTracker(Server):
+    def __init__(self, feedItems=200, latency=0.0, padding=20000):
+        self.top = feedItems
+        self.feedItems = feedItems
+        self.latency = latency
+        self.padding = padding
+        super().__init__(TrackerHandler)
+
+    def publish(self, count):
+        # count new items at the top of the feed
+        self.top += count
+
+
+class QbitHandler(Handler):
+    def do_GET(self):
+        self.api({})
+
+    def do_POST(self):
+        raw = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8', 'replace')
+        if 'multipart' in self.headers.get('Content-Type', ''):
+            data = dict(re.findall(r'name="([^"]+)"\r\n\r\n(.*?)\r\n--', raw, re.S))
+        else:
+            data = dict(parse_qsl(raw))
+        self.api(data)
+
+    def api(self, data):
+        qb = self.server.site
+        path = urlparse(self.path)
+        data.update(parse_qsl(path.query))
+        name = path.path.rsplit('/api/v2/', 1)[-1]
+        qb.count(name)
+        if name == 'auth/login':
+            return self.send('Ok.', headers={'Set-Cookie': 'SID=bench; path=/'})
+        if name == 'app/version':
+            return self.send('v4.5.0')
+        if name == 'app/webapiVersion':
+            return self.send('2.8.19')
+        with qb.lock:
+            if name == 'sync/maindata':
+                return self.send({'rid': 1, 'full_update': True, 'torrents': qb.torrents,
+                                  'server_state': {'free_space_on_disk': qb.free}})
+            if name == 'torrents/info':
+                return self.send(list(qb.torrents.values()))
+            if name == 'torrents/add':
+                for url in data.get('urls', '').split('\n'):
+                    if url:
+                        h = f'{len(qb.torrents):040x}'
+                        qb.torrents[h] = {'hash': h, 'name': url, 'progress': 1, 'amount_left': 0,
+                                          'downloaded': GB, 'seeding_time': 0, 'size': GB}
+                return self.send('Ok.')
+            if name == 'torrents/delete':
+                for h in data.get('hashes', '').split('|'):
+                    qb.torrents.pop(h, None)
+                return self.send('')
+        return self.send(code=404)
+
+
+class FakeQbit(Server):
+    def __init__(self, torrents=200, free=4096 * GB):
+        self.free = free
+        self.torrents = {}
+        for i in range(torrents):
+            h = f'{i:040x}'
+            self.torrents[h] = {'hash': h, 'name': f'seed{i}', 'progress': 1, 'amount_left': 0,
+                                'downloaded': 10 * GB, 'seeding_time': i * 3600, 'size': 10 * GB}
+        super().__init__(QbitHandler)
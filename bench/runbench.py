@@ -0,0 +1,224 @@
+"""Throughput benchmark of the rss pipeline, offline.
+
+    python bench/runbench.py --history 10000,100000,1000000
+
+Runs processRssFeeds against a local fake tracker and fake qBittorrent,
+on a scratch database grown to each history size, and reports items/sec,
+per-item latency, commits and HTTP calls per run, plus the per-call
+latency of lookupRssHistory and qbfunc.plan_space_for_torrents.
+"""
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fakesites
+import feedparser
+
+
+def loadArgs():
+    parser = argparse.ArgumentParser(description='torrss pipeline benchmark.')
+    parser.add_argument('--history', default='10000,100000,1000000',
+                        help='comma separated rss_history sizes, ascending')
+    parser.add_argument('--runs', type=int, default=5, help='runs per history size')
+    parser.add_argument('--feed-items', type=int, default=200, help='items in the feed')
+    parser.add_argument('--new-items', type=int, default=50, help='new items per run')
+    parser.add_argument('--info-pages', action='store_true', help='fetch info pages (task with cookie)')
+    parser.add_argument('--info-latency', type=float, default=0.02, help='info page latency, seconds')
+    parser.add_argument('--site-rate', type=float, default=0, help='info requests/sec per site, 0 unlimited')
+    parser.add_argument('--feedparser', action='store_true', help='parse feeds with feedparser')
+    parser.add_argument('--lookups', type=int, default=200, help='lookupRssHistory calls per size')
+    parser.add_argument('--workdir', help='directory of the scratch database, default a temp dir')
+    return parser.parse_args()
+
+
+def pct(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def ms(seconds):
+    return f'{seconds * 1000:.2f}'
+
+
+class Bench:
+    def __init__(self, args, workdir):
+        # the app reads the database URI at import
+        os.environ['TORRSS_DB'] = 'sqlite:///' + os.path.join(workdir, 'bench.sqlite')
+        global app, myconfig, qbfunc
+        import app
+        import myconfig
+        import qbfunc
+        from sqlalchemy import event
+
+        self.args = args
+        self.tracker = fakesites.FakeTracker(args.feed_items, args.info_latency)
+        self.qbit = fakesites.FakeQbit()
+        cfg = myconfig.CONFIG
+        cfg.qbServer, cfg.qbPort = '127.0.0.1', str(self.qbit.httpd.server_address[1])
+        cfg.qbUser, cfg.qbPass = 'bench', 'bench'
+        cfg.infoCacheFile = ''
+        cfg.siteRate = args.site_rate
+        cfg.siteConcurrency = 4
+        cfg.streamParse = not args.feedparser
+        app.FEED_SHARE_WINDOW = 0
+        app.initDatabase()
+
+        self.commits = 0
+        with app.app.app_context():
+            event.listen(app.db.engine, 'commit', self.onCommit)
+            task = app.RSSTask(rsslink=self.tracker.url + '/rss', site='bench',
+                               size_min=1, size_max=30, title_regex='1080p|2160p',
+                               title_not_regex='HDTV', info_regex='DIY' if args.info_pages else '',
+                               cookie='c_secure_uid=bench' if args.info_pages else '',
+                               total_count=0, accept_count=0, task_interval=5)
+            app.db.session.add(task)
+            app.db.session.commit()
+            self.tid = task.id
+        self.history = 0
+        self.warm = False
+
+        # per item: feed item read -> decision committed; items counted are
+        # the rows a run saved
+        self.itemStart = {}
+        self.itemLatency = []
+        self.saved = 0
+        feedEntries, saveRssRun = app.feedEntries, app.saveRssRun
+
+        def timedEntries(feed, timer):
+            for item in feedEntries(feed, timer):
+                self.itemStart.setdefault(item.title, time.perf_counter())
+                yield item
+
+        def timedSave(records, tasks=()):
+            result = saveRssRun(records, tasks)
+            end = time.perf_counter()
+            for r in records:
+                if r.title in self.itemStart:
+                    self.itemLatency.append(end - self.itemStart.pop(r.title))
+            self.itemStart.clear()
+            self.saved += len(records)
+            return result
+
+        app.feedEntries, app.saveRssRun = timedEntries, timedSave
+
+    def onCommit(self, conn):
+        self.commits += 1
+
+    def growHistory(self, size):
+        # synthetic rows of other sites, the feed items stay new
+        start = time.perf_counter()
+        base = datetime.now() - timedelta(days=365)
+        with app.app.app_context():
+            for lo in range(self.history, size, 50000):
+                rows = [dict(tid=0, site='hist', title=f'Hist.Movie.{i}.1080p.WEB-DL-{i % 97}',
+                             guid=f'hist-{i}', accept=3 if i % 20 == 0 else 0,
+                             reason=None if i % 20 == 0 else 'TITLE_REGEX', size=fakesites.GB,
+                             imdbstr='', addedon=base + timedelta(seconds=i * 30))
+                        for i in range(lo, min(size, lo + 50000))]
+                app.db.session.execute(app.db.insert(app.RSSHistory), rows)
+                app.db.session.commit()
+        if size > self.history:
+            print(f'  history {self.history} -> {size} rows in {time.perf_counter() - start:.1f}s')
+        self.history = size
+
+    def runPipeline(self):
+        runTimes, items, commits, calls = [], [], [], []
+        if not self.warm:
+            # the first run sees the whole feed as new, not measured
+            app.runRssTask(self.tid)
+            self.warm = True
+        self.itemLatency = []
+        for _ in range(self.args.runs):
+            self.tracker.publish(self.args.new_items)
+            self.tracker.takeCalls()
+            self.qbit.takeCalls()
+            self.commits = 0
+            self.saved = 0
+            start = time.perf_counter()
+            app.runRssTask(self.tid)
+            runTimes.append(time.perf_counter() - start)
+            items.append(self.saved)
+            commits.append(self.commits)
+            calls.append((self.tracker.takeCalls(), self.qbit.takeCalls()))
+        return runTimes, items, commits, calls
+
+    def benchLookups(self):
+        # a batch of feed entries as the pipeline checks them, half of them
+        # in the history
+        latencies = []
+        with app.app.app_context():
+            for _ in range(self.args.lookups):
+                entries = []
+                for _ in range(app.FEED_LOOKUP_BATCH):
+                    i = random.randrange(max(1, self.history * 2))
+                    entries.append(feedparser.FeedParserDict(
+                        id=f'hist-{i}', title=f'Hist.Movie.{i}.1080p.WEB-DL-{i % 97}'))
+                app.seenCache.keys.clear()
+                start = time.perf_counter()
+                app.lookupRssHistory(entries)
+                latencies.append(time.perf_counter() - start)
+        return latencies
+
+    def benchSpacePlan(self):
+        snapshot = qbfunc.TorrentSnapshot()
+        snapshot.torrents = {t['hash']: dict(t) for t in self.qbit.torrents.values()}
+        snapshot.aggregate()
+        entries = []
+        for i in range(self.args.new_items):
+            e = qbfunc.DownloadEntry()
+            e.size = fakesites.itemSize(i)
+            entries.append(e)
+        latencies = []
+        for _ in range(200):
+            start = time.perf_counter()
+            qbfunc.plan_space_for_torrents(snapshot, entries, 100 * fakesites.GB)
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    def report(self, size, runTimes, items, commits, calls, lookups, plans):
+        total = sum(runTimes)
+        feedCalls = sum(t.get('feed', 0) for t, _ in calls) / len(calls)
+        infoCalls = sum(t.get('info', 0) for t, _ in calls) / len(calls)
+        qbCalls = sum(sum(q.values()) for _, q in calls) / len(calls)
+        print(f'history {size}:')
+        print(f'  runs {len(runTimes)}, new items/run {sum(items) / len(items):.1f}, '
+              f'run p50 {ms(pct(runTimes, 0.5))} ms, p99 {ms(pct(runTimes, 0.99))} ms, '
+              f'{sum(items) / total:.1f} items/s')
+        print(f'  item latency p50 {ms(pct(self.itemLatency, 0.5))} ms, p99 {ms(pct(self.itemLatency, 0.99))} ms')
+        print(f'  per run: {sum(commits) / len(commits):.1f} commits, http feed {feedCalls:.1f}, '
+              f'info pages {infoCalls:.1f}, qBittorrent {qbCalls:.1f}')
+        print(f'  lookupRssHistory ({app.FEED_LOOKUP_BATCH} entries) '
+              f'p50 {ms(pct(lookups, 0.5))} ms, p99 {ms(pct(lookups, 0.99))} ms')
+        print(f'  plan_space_for_torrents ({len(self.qbit.torrents)} torrents, {self.args.new_items} entries) '
+              f'p50 {ms(pct(plans, 0.5))} ms, p99 {ms(pct(plans, 0.99))} ms')
+
+
+def main():
+    args = loadArgs()
+    workdir = args.workdir or tempfile.mkdtemp(prefix='torrss-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    print(f'scratch database in {workdir}')
+    try:
+        bench = Bench(args, workdir)
+        for size in sorted(int(x) for x in args.history.split(',') if x):
+            bench.growHistory(size)
+            result = bench.runPipeline()
+            bench.report(size, *result, bench.benchLookups(), bench.benchSpacePlan())
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    from loguru import logger
+    logger.remove()
+    logger.add(sys.stderr, level='WARNING')
+    main()
@@ -0,0 +1,120 @@
+import feedparser
+from lxml import etree
+from loguru import logger
+
+import infopage
+
+# Incremental feed reading: entries are parsed one <item>/<entry> at a time
+# straight from the response with lxml iterparse, and the caller can stop
+# reading once the rest of the feed is known (newest-first feeds). Entries
+# are FeedParserDicts shaped like feedparser's (id, title, link, links with
+# the enclosure at links[1]), so processRssFeeds takes either.
+
+ATOM = '{http://www.w3.org/2005/Atom}'
+RSS1 = '{http://purl.org/rss/1.0/}'
+RDF = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}'
+ENTRY_TAGS = ('item', RSS1 + 'item', ATOM + 'entry')
+FEED_TIMEOUT = (10, 60)
+
+
+def childText(elem, *tags):
+    for tag in tags:
+        child = elem.find(tag)
+        if child is not None and child.text:
+            return child.text.strip()
+    return None
+
+
+def parseEntry(elem):
+    entry = feedparser.FeedParserDict()
+    links = []
+    enclosure = None
+    if elem.tag.startswith(ATOM):
+        guid = childText(elem, ATOM + 'id')
+        title = childText(elem, ATOM + 'title')
+        link = None
+        for a in elem.iterfind(ATOM + 'link'):
+            rel = a.get('rel', 'alternate')
+            if rel == 'alternate' and link is None:
+                link = a.get('href')
+            elif rel == 'enclosure' and enclosure is None:
+                enclosure = {'rel': 'enclosure', 'href': a.get('href', ''),
+                             'length': a.get('length', '0'), 'type': a.get('type', '')}
+    else:
+        ns = RSS1 if elem.tag.startswith(RSS1) else ''
+        guid = childText(elem, 'guid') or elem.get(RDF + 'about')
+        title = childText(elem, ns + 'title')
+        link = childText(elem, ns + 'link')
+        enc = elem.find('enclosure')
+        if enc is not None:
+            enclosure = {'rel': 'enclosure', 'href': enc.get('url', ''),
+                         'length': enc.get('length', '0'), 'type': enc.get('type', '')}
+
+    if guid:
+        entry['id'] = guid
+    if title is not None:
+        entry['title'] = title
+    if link:
+        entry['link'] = link
+        links.append({'rel': 'alternate', 'type': 'text/html', 'href': link})
+    if enclosure:
+        if not links:
+            # keep the enclosure at links[1] as feedparser does
+            links.append({'rel': 'alternate', 'type': 'text/html', 'href': ''})
+        links.append(enclosure)
+    if links:
+        entry['links'] = links
+    return entry
+
+
+class FeedStream:
+    # status / etag / modified like a feedparser result; entries is a
+    # generator, close() stops reading and releases the connection
+    def __init__(self, url, response):
+        self.url = url
+        self.response = response
+        self.status = response.status_code
+        self.etag = response.headers.get('ETag', '')
+        self.modified = response.headers.get('Last-Modified', '')
+        self.parsed = 0
+        self.entries = self.iterEntries() if self.status == 200 else iter(())
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def iterEntries(self):
+        self.response.raw.decode_content = True
+        try:
+            for _, elem in etree.iterparse(self.response.raw, events=('end',), tag=ENTRY_TAGS,
+                                           resolve_entities=False, no_network=True):
+                entry = parseEntry(elem)
+                # drop the parsed entry and everything before it
+                elem.clear(keep_tail=True)
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+                self.parsed += 1
+                yield entry
+        except etree.XMLSyntaxError as e:
+            if self.parsed:
+                logger.warning(f'Feed {infopage.normalizeInfoLink(self.url)}: broken after {self.parsed} entries ({e})')
+            else:
+                # not something lxml reads, let feedparser try the whole body
+                logger.warning(f'Feed {infopage.normalizeInfoLink(self.url)}: not XML ({e}), fall back to feedparser')
+                yield from feedparser.parse(self.url).entries
+        finally:
+            self.close()
+
+    def close(self):
+        self.response.close()
+
+
+def openFeed(url, etag=None, modified=None):
+    # conditional GET on the pooled keep-alive session of the feed host
+    headers = {'Accept': 'application/rss+xml, application/atom+xml, application/xml;q=0.9, */*;q=0.8'}
+    if etag:
+        headers['If-None-Match'] = etag
+    if modified:
+        headers['If-Modified-Since'] = modified
+    session = infopage.sessionPool.get(url, '')
+    response = session.get(url, headers=headers, stream=True, timeout=FEED_TIMEOUT)
+    return FeedStream(url, response)
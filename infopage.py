@@ -0,0 +1,468 @@
+import os
+import re
+import time
+import zlib
+import codecs
+import sqlite3
+import hashlib
+import threading
+import requests as pyrequests
+from http.cookies import SimpleCookie
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from loguru import logger
+
+import myconfig
+import metrics
+
+
+def tryFloat(fstr):
+    try:
+        f = float(fstr)
+    except:
+        f = 0.0
+    return f
+
+
+INFO_HEADERS = {
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.9",
+    'User-Agent':
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/109.0.0.0 Safari/537.36 Edg/109.0.1518.78",
+    'Content-Type': 'text/html; charset=UTF-8'
+}
+
+
+class SessionPool:
+    # one keep-alive requests.Session per (site, cookie), so pages of the
+    # same tracker reuse the TCP+TLS connection; least recently used and
+    # idle sessions are closed
+    def __init__(self, max_sessions=16, idle_timeout=300):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def newSession(self, pageCookie):
+        session = pyrequests.Session()
+        cookie = SimpleCookie()
+        cookie.load(pageCookie)
+        session.cookies.update({k: v.value for k, v in cookie.items()})
+        session.headers.update(INFO_HEADERS)
+        size = max(1, myconfig.CONFIG.siteConcurrency)
+        adapter = pyrequests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def get(self, pageUrl, pageCookie):
+        key = (urlparse(pageUrl).netloc, pageCookie)
+        now = time.monotonic()
+        expired = []
+        with self.lock:
+            for k, (session, last_used) in list(self.sessions.items()):
+                if now - last_used > self.idle_timeout:
+                    expired.append(self.sessions.pop(k)[0])
+            entry = self.sessions.get(key)
+            if entry:
+                session = entry[0]
+            else:
+                if len(self.sessions) >= self.max_sessions:
+                    lru = min(self.sessions, key=lambda k: self.sessions[k][1])
+                    expired.append(self.sessions.pop(lru)[0])
+                session = self.newSession(pageCookie)
+            self.sessions[key] = (session, now)
+        for old in expired:
+            old.close()
+        return session
+
+
+sessionPool = SessionPool()
+
+
+# ratings are looked for within this many chars after an "IMDb" / "豆瓣评分"
+RATING_WINDOW = 512
+IMDB_ID = re.compile(r'www\.imdb\.com\/title\/(tt\d+)', flags=re.A)
+IMDB_ANCHOR = re.compile(r'IMDb', flags=re.I)
+IMDB_RATING = re.compile(r'IMDb.*?([0-9.]+)\s*/\s*10', flags=re.I)
+DOUBAN_ANCHOR = re.compile(r'豆瓣评分', flags=re.I)
+DOUBAN_RATING = re.compile(r'豆瓣评分.*?([0-9.]+)/10', flags=re.I)
+RATING_LINE = re.compile(r'Rating:.*?([0-9.]+)\s*/\s*10\s*from', flags=re.I)
+# read size of a page download
+INFO_CHUNK = 64 * 1024
+
+
+def firstRating(doc, anchor, pattern, start=0):
+    # the first rating after an anchor, looked for only in the window after
+    # each anchor, not up to the end of a (maybe 500 KB) line
+    for m in anchor.finditer(doc, start):
+        r = pattern.match(doc, m.start(), m.start() + RATING_WINDOW)
+        if r:
+            return tryFloat(r[1])
+    return None
+
+
+class PageNeeds:
+    # the fields a task reads from its info pages: the imdb id always,
+    # ratings with min_imdb, and the info_regex / info_not_regex; a page
+    # download stops once none is pending
+    def __init__(self, minImdb=0, infoRegex=None, infoNotRegex=None):
+        self.minImdb = minImdb or 0
+        self.infoRegex = infoRegex
+        self.infoNotRegex = infoNotRegex
+
+    def scanner(self):
+        return PageScan(self)
+
+    def resolved(self, doc):
+        return self.scanner().feed(doc)
+
+
+class PageScan:
+    # checks the page read so far against PageNeeds; a check restarts
+    # SCAN_OVERLAP chars before the end of the previous one, so a field cut
+    # by a chunk boundary is found on the next chunk
+    SCAN_OVERLAP = RATING_WINDOW + 64
+
+    def __init__(self, needs):
+        self.needs = needs
+        self.pending = {'imdb_id'}
+        if needs.minImdb:
+            self.pending.add('rating')
+        if needs.infoRegex:
+            self.pending.add('info_regex')
+        if needs.infoNotRegex:
+            # only a match settles it, no match needs the whole page
+            self.pending.add('info_not_regex')
+        self.imdbval = None
+        self.doubanval = None
+        self.checked = 0
+
+    def feed(self, doc):
+        # doc: the page so far, returns True when nothing is pending
+        start = max(0, self.checked - self.SCAN_OVERLAP)
+        self.checked = len(doc)
+        if 'imdb_id' in self.pending and IMDB_ID.search(doc, start):
+            self.pending.discard('imdb_id')
+        if 'rating' in self.pending:
+            if self.imdbval is None:
+                self.imdbval = firstRating(doc, IMDB_ANCHOR, IMDB_RATING, start)
+            if self.doubanval is None:
+                self.doubanval = firstRating(doc, DOUBAN_ANCHOR, DOUBAN_RATING, start)
+            # one rating over min_imdb passes, a reject reason needs both
+            found = [v for v in (self.imdbval, self.doubanval) if v is not None]
+            if len(found) == 2 or any(v >= self.needs.minImdb for v in found):
+                self.pending.discard('rating')
+        if 'info_regex' in self.pending and self.needs.infoRegex.search(doc, start):
+            self.pending.discard('info_regex')
+        if 'info_not_regex' in self.pending and self.needs.infoNotRegex.search(doc, start):
+            self.pending.discard('info_not_regex')
+        return not self.pending
+
+
+def fetchInfoPage(pageUrl, pageCookie, needs=None):
+    # reads the page in chunks until the end, myconfig.CONFIG.infoMaxKB, or
+    # until the fields of needs are all found; returns (doc, complete),
+    # complete False for a page cut short, ('', True) when the fetch failed
+    maxBytes = myconfig.CONFIG.infoMaxKB * 1024
+    scan = needs.scanner() if needs else None
+    doc, read, complete = '', 0, True
+    try:
+        session = sessionPool.get(pageUrl, pageCookie)
+        # closing a response cut short drops its connection
+        with session.get(pageUrl, timeout=15, stream=True) as r:
+            # the pages are utf-8, whatever the headers say
+            decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+            for chunk in r.iter_content(chunk_size=INFO_CHUNK):
+                read += len(chunk)
+                doc += decoder.decode(chunk)
+                if (scan and scan.feed(doc)) or (maxBytes and read >= maxBytes):
+                    complete = False
+                    break
+            else:
+                doc += decoder.decode(b'', final=True)
+    except:
+        return '', True
+
+    return doc, complete
+
+
+def parseInfoPageIMDbval(doc):
+    imdbval = firstRating(doc, IMDB_ANCHOR, IMDB_RATING) or 0
+    doubanval = firstRating(doc, DOUBAN_ANCHOR, DOUBAN_RATING) or 0
+    if imdbval < 1 and doubanval < 1:
+        ratelist = [x[1] for x in RATING_LINE.finditer(doc)]
+        if len(ratelist) >= 2:
+            doubanval = tryFloat(ratelist[0])
+            imdbval = tryFloat(ratelist[1])
+        elif len(ratelist) == 1:
+            # TODO: 不分辨douban/imdb了
+            doubanval = tryFloat(ratelist[0])
+            imdbval = doubanval
+            # rate1 = re.search(r'Rating:.*?([0-9.]+)\s*/\s*10\s*from', doc, flags=re.A)
+            # if rate1:
+            #     imdbval = tryFloat(rate1[1])
+        # print("   >> IMDb: %s, douban: %s" % (imdbval, doubanval))
+    return imdbval, doubanval
+
+
+def parseInfoPageIMDbId(doc):
+    imdbstr = ''
+    m1 = IMDB_ID.search(doc)
+    if m1:
+        imdbstr = m1[1]
+    return imdbstr
+
+
+class InfoPage:
+    # an info page and the fields extracted from it; complete is False for
+    # a page read only up to the fields a task needed, or the byte cap
+    def __init__(self, doc, imdbstr=None, imdbval=None, doubanval=None, complete=True):
+        self.doc = doc
+        self.complete = complete
+        if imdbstr is None:
+            imdbstr = parseInfoPageIMDbId(doc)
+        if imdbval is None or doubanval is None:
+            imdbval, doubanval = parseInfoPageIMDbval(doc)
+        self.imdbstr = imdbstr
+        self.imdbval = imdbval
+        self.doubanval = doubanval
+
+
+# query parameters that do not change the page: per-user keys, hit counters
+VOLATILE_PARAMS = {'passkey', 'hit', 'downhash'}
+
+
+def normalizeInfoLink(pageUrl):
+    u = urlparse(pageUrl.strip())
+    query = sorted((k, v) for k, v in parse_qsl(u.query, keep_blank_values=True)
+                   if k.lower() not in VOLATILE_PARAMS)
+    return urlunparse((u.scheme.lower(), u.netloc.lower(), u.path, u.params,
+                       urlencode(query), ''))
+
+
+class InfoCache:
+    # on-disk cache of fetched info pages keyed by normalized link, shared by
+    # all tasks and kept across restarts; entries expire after `ttl` seconds
+    # and the least recently used go when the bodies exceed `max_bytes`.
+    # A page cut short serves only the tasks whose fields it holds
+    def __init__(self, path, ttl, max_bytes):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS info_cache ('
+                'link TEXT PRIMARY KEY, imdbstr TEXT, imdbval REAL, doubanval REAL, '
+                'content_hash TEXT, body BLOB, size INTEGER, fetched REAL, accessed REAL, '
+                'complete INTEGER DEFAULT 1)')
+            self.conn.execute(
+                'CREATE INDEX IF NOT EXISTS ix_info_cache_accessed ON info_cache (accessed)')
+            columns = [r[1] for r in self.conn.execute('PRAGMA table_info(info_cache)')]
+            if 'complete' not in columns:
+                # cache file of an older version, its pages were read whole
+                self.conn.execute('ALTER TABLE info_cache ADD COLUMN complete INTEGER DEFAULT 1')
+        return self.conn
+
+    def get(self, pageUrl, needs=None):
+        key = normalizeInfoLink(pageUrl)
+        now = time.time()
+        with self.lock:
+            conn = self.connect()
+            row = conn.execute(
+                'SELECT imdbstr, imdbval, doubanval, body, fetched, complete FROM info_cache WHERE link = ?',
+                (key,)).fetchone()
+            if not row:
+                return None
+            if now - row[4] > self.ttl:
+                conn.execute('DELETE FROM info_cache WHERE link = ?', (key,))
+                conn.commit()
+                return None
+            conn.execute('UPDATE info_cache SET accessed = ? WHERE link = ?', (now, key))
+            conn.commit()
+        doc = zlib.decompress(row[3]).decode('utf-8')
+        complete = bool(row[5])
+        if not complete and (needs is None or not needs.resolved(doc)):
+            # cut short for another task, fetched again
+            return None
+        return InfoPage(doc, row[0], row[1], row[2], complete)
+
+    def put(self, pageUrl, page):
+        key = normalizeInfoLink(pageUrl)
+        body = zlib.compress(page.doc.encode('utf-8'))
+        content_hash = hashlib.sha1(body).hexdigest()
+        now = time.time()
+        with self.lock:
+            conn = self.connect()
+            conn.execute(
+                'INSERT OR REPLACE INTO info_cache VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (key, page.imdbstr, page.imdbval, page.doubanval, content_hash,
+                 body, len(body), now, now, int(page.complete)))
+            self.evict(conn, now)
+            conn.commit()
+
+    def evict(self, conn, now):
+        conn.execute('DELETE FROM info_cache WHERE fetched < ?', (now - self.ttl,))
+        total = conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM info_cache').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess = total - self.max_bytes
+        for link, size in conn.execute(
+                'SELECT link, size FROM info_cache ORDER BY accessed').fetchall():
+            conn.execute('DELETE FROM info_cache WHERE link = ?', (link,))
+            excess -= size
+            if excess <= 0:
+                break
+
+
+_infoCache = None
+
+
+def infoCache():
+    global _infoCache
+    with _limitersLock:
+        if _infoCache is None and myconfig.CONFIG.infoCacheFile:
+            _infoCache = InfoCache(myconfig.CONFIG.infoCacheFile,
+                                   myconfig.CONFIG.infoCacheTTL * 3600,
+                                   myconfig.CONFIG.infoCacheMB * 1024 * 1024)
+    return _infoCache
+
+
+class SiteLimiter:
+    # at most `concurrency` requests in flight to one site, and request
+    # starts spaced to stay under `rate` requests per second (0: no cap).
+    # Requests wait in the site's queue, not in a thread of the shared pool,
+    # so a slow or rate limited site does not hold up the other sites
+    def __init__(self, concurrency, rate):
+        self.concurrency = max(1, concurrency)
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.next_start = 0.0
+        self.running = 0
+        self.waiting = deque()
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        future = Future()
+        with self.lock:
+            self.waiting.append((future, fn, args))
+        self.dispatch()
+        return future
+
+    def dispatch(self):
+        with self.lock:
+            while self.waiting and self.running < self.concurrency:
+                now = time.monotonic()
+                if self.next_start > now:
+                    # back when the next start is due, no thread waits for it
+                    if not self.timer:
+                        self.timer = threading.Timer(self.next_start - now, self.timerDue)
+                        self.timer.daemon = True
+                        self.timer.start()
+                    return
+                self.next_start = max(now, self.next_start) + self.interval
+                self.running += 1
+                infoExecutor().submit(self.run, *self.waiting.popleft())
+
+    def timerDue(self):
+        with self.lock:
+            self.timer = None
+        self.dispatch()
+
+    def run(self, future, fn, args):
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args))
+                except Exception as e:
+                    future.set_exception(e)
+        finally:
+            with self.lock:
+                self.running -= 1
+            self.dispatch()
+
+
+_limiters = {}
+_limitersLock = threading.Lock()
+_executor = None
+
+
+def siteLimiter(pageUrl):
+    site = urlparse(pageUrl).netloc
+    with _limitersLock:
+        limiter = _limiters.get(site)
+        if not limiter:
+            limiter = SiteLimiter(myconfig.CONFIG.siteConcurrency,
+                                  myconfig.CONFIG.siteRate)
+            _limiters[site] = limiter
+    return limiter
+
+
+def infoExecutor():
+    # one bounded pool shared by all tasks
+    global _executor
+    with _limitersLock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=max(1, myconfig.CONFIG.infoWorkers),
+                thread_name_prefix='infopage')
+    return _executor
+
+
+def fetchPage(pageUrl, pageCookie, task='', site='', needs=None):
+    start = time.perf_counter()
+    doc, complete = fetchInfoPage(pageUrl, pageCookie, needs)
+    metrics.observe('info_fetch', time.perf_counter() - start, task, site)
+    if not doc:
+        return None
+    start = time.perf_counter()
+    page = InfoPage(doc, complete=complete)
+    metrics.observe('rating_parse', time.perf_counter() - start, task, site)
+    cache = infoCache()
+    if cache:
+        try:
+            cache.put(pageUrl, page)
+        except Exception as e:
+            logger.warning(f'   !! info cache write: {e}')
+    return page
+
+
+def cachedPage(pageUrl, needs=None):
+    cache = infoCache()
+    if cache:
+        try:
+            return cache.get(pageUrl, needs)
+        except Exception as e:
+            logger.warning(f'   !! info cache read: {e}')
+    return None
+
+
+def fetchInfoPages(pageUrls, pageCookie, task='', site='', needs=None):
+    # fetch the pages concurrently, returns {pageUrl: InfoPage}, None when failed;
+    # task / site label the metrics, needs: PageNeeds to stop a download early.
+    # Cached pages are read here, the others queued per site
+    pages = {}
+    futures = {}
+    for url in dict.fromkeys(pageUrls):
+        page = cachedPage(url, needs)
+        if page:
+            pages[url] = page
+        else:
+            futures[url] = siteLimiter(url).submit(fetchPage, url, pageCookie, task, site, needs)
+    for url, future in futures.items():
+        try:
+            pages[url] = future.result()
+        except Exception as e:
+            logger.error(f'   !! fetch info page: {e}')
+            pages[url] = None
+    return pages
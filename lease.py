@@ -0,0 +1,65 @@
+import os
+import socket
+from datetime import datetime, timedelta
+import sqlalchemy as sa
+
+# Leases in rss_lease decide which worker process schedules a task (and
+# runs the history maintenance). A worker renews its leases on every job
+# sync; the leases of a worker that stopped renewing expire after
+# LEASE_TTL seconds and go to the next worker that asks. Each worker also
+# holds a worker:<id> lease, the count of these is the number of live
+# workers the tasks are shared among.
+
+LEASE_TTL = 60
+WORKER_ID = f'{socket.gethostname()}:{os.getpid()}'
+WORKER_LEASE = f'worker:{WORKER_ID}'
+
+
+def timestamp(dt):
+    return dt.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def acquire(engine, names, ttl=LEASE_TTL):
+    # takes or renews the leases, returns the names this worker holds
+    if not names:
+        return set()
+    now = datetime.now()
+    params = [{'name': name, 'owner': WORKER_ID,
+               'expires': timestamp(now + timedelta(seconds=ttl)), 'now': timestamp(now)}
+              for name in names]
+    owners = sa.text('SELECT name FROM rss_lease WHERE owner = :owner AND name IN :names').bindparams(
+        sa.bindparam('names', expanding=True))
+    with engine.begin() as conn:
+        conn.execute(sa.text(
+            'INSERT INTO rss_lease (name, owner, expires) VALUES (:name, :owner, :expires) '
+            'ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires = excluded.expires '
+            'WHERE rss_lease.owner = excluded.owner OR rss_lease.expires < :now'), params)
+        held = conn.execute(owners, {'owner': WORKER_ID, 'names': list(names)}).fetchall()
+    return {r[0] for r in held}
+
+
+def holders(engine):
+    # name -> owner of the leases not expired
+    with engine.connect() as conn:
+        rows = conn.execute(sa.text('SELECT name, owner FROM rss_lease WHERE expires >= :now'),
+                            {'now': timestamp(datetime.now())}).fetchall()
+    return {r[0]: r[1] for r in rows}
+
+
+def release(engine, names=None, owner=WORKER_ID):
+    # the given leases, or all of this worker's; owner None: whoever holds
+    # them, e.g. the lease of a deleted task
+    if names is not None and not names:
+        return
+    where, params = [], {}
+    if owner is not None:
+        where.append('owner = :owner')
+        params['owner'] = owner
+    if names is not None:
+        where.append('name IN :names')
+        params['names'] = list(names)
+    stmt = sa.text('DELETE FROM rss_lease' + (' WHERE ' + ' AND '.join(where) if where else ''))
+    if names is not None:
+        stmt = stmt.bindparams(sa.bindparam('names', expanding=True))
+    with engine.begin() as conn:
+        conn.execute(stmt, params)
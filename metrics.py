@@ -0,0 +1,187 @@
+import time
+import threading
+from contextlib import contextmanager
+
+# Latency histograms of the rss pipeline stages, labelled by task id and
+# site, for /metrics (Prometheus text format) and the /stats page. Worker
+# processes publish snapshot() for the web process, see workerstats.py.
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+METRIC = 'torrss_stage_seconds'
+
+# stage name -> description, in pipeline order
+STAGES = {
+    'fetch': 'feed request until the response headers',
+    'parse': 'reading / parsing feed entries',
+    'dedup': 'history lookups of the entries',
+    'title_filter': 'size and title rules',
+    'info_pages': 'info page fetches of a run (wall time)',
+    'info_fetch': 'one info page request',
+    'rating_parse': 'IMDb / douban parse of one info page',
+    'info_filter': 'info page rules',
+    'free_space': 'qBittorrent free space query',
+    'qbit_add': 'space planning and qBittorrent add',
+    'db_commit': 'history insert and commit',
+    'run': 'whole run',
+}
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        i = 0
+        while i < len(BUCKETS) and value > BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        for i, c in enumerate(other.counts):
+            self.counts[i] += c
+        self.sum += other.sum
+        self.count += other.count
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the q-th observation
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                return BUCKETS[i] if i < len(BUCKETS) else self.max
+        return self.max
+
+
+_histograms = {}
+_lock = threading.Lock()
+
+
+def observe(stage, seconds, task='', site=''):
+    key = (stage, str(task or ''), site or '')
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = Histogram()
+        hist.observe(seconds)
+
+
+class RunTimer:
+    # sums the time of each stage over one task run, observed once per run
+    # by finish(); stages hit many times per run (filters, lookups) are
+    # measured without taking the lock each time
+    def __init__(self, task, site):
+        self.task = task
+        self.site = site
+        self.totals = {}
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        self.totals[name] = self.totals.get(name, 0.0) + seconds
+
+    def finish(self, run=True):
+        for name, seconds in self.totals.items():
+            observe(name, seconds, self.task, self.site)
+        if run:
+            observe('run', time.perf_counter() - self.start, self.task, self.site)
+        self.totals = {}
+
+
+def snapshot():
+    # JSON-able copy of this process's histograms
+    with _lock:
+        return [[stage, task, site, h.counts[:], h.sum, h.count, h.max]
+                for (stage, task, site), h in _histograms.items()]
+
+
+def mergeSnapshots(snapshots):
+    # histograms of several processes, summed per (stage, task, site)
+    merged = {}
+    for snap in snapshots:
+        for stage, task, site, counts, total, count, maxValue in snap:
+            hist = merged.get((stage, task, site))
+            if hist is None:
+                hist = merged[(stage, task, site)] = Histogram()
+            other = Histogram()
+            other.counts, other.sum, other.count, other.max = counts, total, count, maxValue
+            hist.merge(other)
+    return merged
+
+
+def localHistograms():
+    with _lock:
+        return dict(_histograms)
+
+
+def escapeLabel(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render(gauges=None, histograms=None):
+    # Prometheus text exposition; gauges: {name: (help, value)};
+    # histograms: from mergeSnapshots(), this process's by default
+    if histograms is None:
+        histograms = localHistograms()
+    with _lock:
+        items = [(k, h.counts[:], h.sum, h.count) for k, h in sorted(histograms.items())]
+    lines = [f'# HELP {METRIC} Time spent per rss pipeline stage.',
+             f'# TYPE {METRIC} histogram']
+    for (stage, task, site), counts, total, count in items:
+        labels = f'stage="{stage}",task="{task}",site="{escapeLabel(site)}"'
+        cumulative = 0
+        for bound, c in zip(BUCKETS + ('+Inf',), counts):
+            cumulative += c
+            lines.append(f'{METRIC}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{METRIC}_sum{{{labels}}} {total:.6f}')
+        lines.append(f'{METRIC}_count{{{labels}}} {count}')
+    for name, (desc, value) in (gauges or {}).items():
+        lines.append(f'# HELP torrss_{name} {desc}')
+        lines.append(f'# TYPE torrss_{name} gauge')
+        lines.append(f'torrss_{name} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def summary(by='site', histograms=None):
+    # rows per (stage, site) or (stage, task) for the stats page, slowest
+    # average first
+    if histograms is None:
+        histograms = localHistograms()
+    groups = {}
+    with _lock:
+        for (stage, task, site), hist in histograms.items():
+            key = (stage, site if by == 'site' else task)
+            merged = groups.get(key)
+            if merged is None:
+                merged = groups[key] = Histogram()
+            merged.merge(hist)
+    rows = []
+    for (stage, label), hist in groups.items():
+        rows.append({
+            'stage': stage,
+            'label': label,
+            'count': hist.count,
+            'avg_ms': round(hist.sum * 1000 / hist.count, 1) if hist.count else 0,
+            'p50_ms': round(hist.quantile(0.5) * 1000, 1),
+            'p95_ms': round(hist.quantile(0.95) * 1000, 1),
+            'max_ms': round(hist.max * 1000, 1),
+            'total_s': round(hist.sum, 2),
+        })
+    rows.sort(key=lambda r: r['avg_ms'], reverse=True)
+    return rows
@@ -0,0 +1,217 @@
+import time
+import sqlalchemy as sa
+from loguru import logger
+
+# Versioned schema migrations for db.sqlite, tracked by `PRAGMA user_version`.
+# create_all only creates missing tables, every later change to an
+# existing table goes here as a new step at the end of MIGRATIONS.
+# Steps must be idempotent: on a fresh database the tables were just created
+# from the models and already have the new columns/indexes.
+
+
+def columnExists(conn, table, column):
+    rows = conn.execute(sa.text(f'PRAGMA table_info({table})')).fetchall()
+    return any(r[1] == column for r in rows)
+
+
+def addColumn(conn, table, column, coltype):
+    if not columnExists(conn, table, column):
+        conn.execute(sa.text(
+            f'ALTER TABLE {table} ADD COLUMN {column} {coltype}'))
+
+
+def migrateConditionalGet(conn):
+    addColumn(conn, 'rss_task', 'etag', 'VARCHAR(256)')
+    addColumn(conn, 'rss_task', 'last_modified', 'VARCHAR(64)')
+    addColumn(conn, 'rss_task', 'fetch_count', 'INTEGER')
+    addColumn(conn, 'rss_task', 'notmodified_count', 'INTEGER')
+    addColumn(conn, 'rss_history', 'guid', 'VARCHAR(255)')
+
+
+def migrateHistoryIndexes(conn):
+    conn.execute(sa.text('DROP INDEX IF EXISTS ix_rss_history_guid'))
+    # rows written by concurrent tasks before the unique index existed
+    conn.execute(sa.text(
+        'UPDATE rss_history SET guid = NULL WHERE guid IS NOT NULL AND id NOT IN '
+        '(SELECT MIN(id) FROM rss_history WHERE guid IS NOT NULL GROUP BY guid)'))
+    conn.execute(sa.text(
+        'CREATE UNIQUE INDEX IF NOT EXISTS ux_rss_history_guid ON rss_history (guid)'))
+    conn.execute(sa.text(
+        'CREATE INDEX IF NOT EXISTS ix_rss_history_title ON rss_history (title)'))
+    conn.execute(sa.text(
+        'CREATE INDEX IF NOT EXISTS ix_rss_history_tid_addedon ON rss_history (tid, addedon)'))
+    conn.execute(sa.text(
+        'CREATE INDEX IF NOT EXISTS ix_rss_history_addedon ON rss_history (addedon)'))
+    conn.execute(sa.text(
+        'CREATE INDEX IF NOT EXISTS ix_rss_history_accept ON rss_history (accept)'))
+    conn.execute(sa.text(
+        'CREATE INDEX IF NOT EXISTS ix_rss_history_site ON rss_history (site)'))
+    conn.execute(sa.text(
+        'CREATE INDEX IF NOT EXISTS ix_rss_task_rsslink ON rss_task (rsslink)'))
+    conn.execute(sa.text(
+        'CREATE INDEX IF NOT EXISTS ix_rss_task_site ON rss_task (site)'))
+
+
+def migrateHistoryCount(conn):
+    # row count of rss_history maintained by triggers, so the log view does
+    # not run count(*) over the whole table for every page
+    conn.execute(sa.text(
+        'CREATE TABLE IF NOT EXISTS rss_history_count ('
+        'id INTEGER PRIMARY KEY CHECK (id = 1), total INTEGER NOT NULL)'))
+    conn.execute(sa.text(
+        'INSERT OR REPLACE INTO rss_history_count (id, total) '
+        'SELECT 1, COUNT(*) FROM rss_history'))
+    conn.execute(sa.text(
+        'CREATE TRIGGER IF NOT EXISTS rss_history_count_ins AFTER INSERT ON rss_history '
+        'BEGIN UPDATE rss_history_count SET total = total + 1 WHERE id = 1; END'))
+    conn.execute(sa.text(
+        'CREATE TRIGGER IF NOT EXISTS rss_history_count_del AFTER DELETE ON rss_history '
+        'BEGIN UPDATE rss_history_count SET total = total - 1 WHERE id = 1; END'))
+
+
+def migrateHistoryFts(conn):
+    # FTS5 index over the searchable history columns, kept in sync by
+    # triggers; the trigram tokenizer matches substrings like the LIKE
+    # search it replaces (CJK titles have no word breaks). Skipped when the
+    # sqlite library has no FTS5 / trigram (sqlite < 3.34), search falls
+    # back to LIKE
+    try:
+        conn.execute(sa.text(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS rss_history_fts USING fts5('
+            'title, site, reason, imdbstr, '
+            "content='rss_history', content_rowid='id', tokenize='trigram')"))
+    except sa.exc.OperationalError as e:
+        logger.warning(f'DB migrate: no FTS5 trigram in sqlite, history search uses LIKE ({e})')
+        return
+    conn.execute(sa.text(
+        'CREATE TRIGGER IF NOT EXISTS rss_history_fts_ins AFTER INSERT ON rss_history BEGIN '
+        'INSERT INTO rss_history_fts (rowid, title, site, reason, imdbstr) '
+        'VALUES (new.id, new.title, new.site, new.reason, new.imdbstr); END'))
+    conn.execute(sa.text(
+        'CREATE TRIGGER IF NOT EXISTS rss_history_fts_del AFTER DELETE ON rss_history BEGIN '
+        'INSERT INTO rss_history_fts (rss_history_fts, rowid, title, site, reason, imdbstr) '
+        "VALUES ('delete', old.id, old.title, old.site, old.reason, old.imdbstr); END"))
+    conn.execute(sa.text(
+        'CREATE TRIGGER IF NOT EXISTS rss_history_fts_upd AFTER UPDATE ON rss_history BEGIN '
+        'INSERT INTO rss_history_fts (rss_history_fts, rowid, title, site, reason, imdbstr) '
+        "VALUES ('delete', old.id, old.title, old.site, old.reason, old.imdbstr); "
+        'INSERT INTO rss_history_fts (rowid, title, site, reason, imdbstr) '
+        'VALUES (new.id, new.title, new.site, new.reason, new.imdbstr); END'))
+    conn.execute(sa.text(
+        "INSERT INTO rss_history_fts (rss_history_fts) VALUES ('rebuild')"))
+
+
+def migrateHistoryTrigram(conn):
+    # an index of v4 built with the default word tokenizer missed substrings
+    # ('游戏' in '权力的游戏', '265' in 'x265'), rebuilt with trigram
+    sql = conn.execute(sa.text(
+        "SELECT sql FROM sqlite_master WHERE name = 'rss_history_fts'")).scalar()
+    if sql and 'trigram' in sql:
+        return
+    for trigger in ('ins', 'del', 'upd'):
+        conn.execute(sa.text(f'DROP TRIGGER IF EXISTS rss_history_fts_{trigger}'))
+    conn.execute(sa.text('DROP TABLE IF EXISTS rss_history_fts'))
+    migrateHistoryFts(conn)
+
+
+def migrateSeenSet(conn):
+    # 64-bit hashes of the guid / title of archived history rows, see retention.py
+    conn.execute(sa.text(
+        'CREATE TABLE IF NOT EXISTS rss_seen (key INTEGER PRIMARY KEY)'))
+
+
+def migrateAdaptiveInterval(conn):
+    addColumn(conn, 'rss_task', 'adaptive', 'BOOLEAN')
+    addColumn(conn, 'rss_task', 'current_interval', 'FLOAT')
+
+
+def migrateWorkerLease(conn):
+    # web / worker split: run-now requests go through the task row, and a
+    # lease per task decides which worker schedules it, see lease.py
+    addColumn(conn, 'rss_task', 'run_requested', 'DATETIME')
+    conn.execute(sa.text(
+        'CREATE TABLE IF NOT EXISTS rss_lease ('
+        'name VARCHAR(64) PRIMARY KEY, owner VARCHAR(128) NOT NULL, expires DATETIME NOT NULL)'))
+
+
+def migrateTaskDecisions(conn):
+    # one history row per item and task: the reject reasons of every task on
+    # a shared feed are kept, not only those of the first one
+    conn.execute(sa.text('DROP INDEX IF EXISTS ux_rss_history_guid'))
+    conn.execute(sa.text(
+        'CREATE UNIQUE INDEX IF NOT EXISTS ux_rss_history_guid_tid ON rss_history (guid, tid)'))
+
+
+def migrateWorkerStats(conn):
+    # metrics snapshots of the worker processes, see workerstats.py
+    conn.execute(sa.text(
+        'CREATE TABLE IF NOT EXISTS worker_stats ('
+        'worker VARCHAR(128) PRIMARY KEY, updated DATETIME NOT NULL, data TEXT NOT NULL)'))
+
+
+# (version, description, step)
+MIGRATIONS = [
+    (1, 'conditional GET columns, history guid', migrateConditionalGet),
+    (2, 'history / task indexes, unique guid', migrateHistoryIndexes),
+    (3, 'history row count table', migrateHistoryCount),
+    (4, 'history full-text search index', migrateHistoryFts),
+    (5, 'seen set of archived history', migrateSeenSet),
+    (6, 'adaptive interval columns', migrateAdaptiveInterval),
+    (7, 'worker leases, run-now requests', migrateWorkerLease),
+    (8, 'trigram history search index', migrateHistoryTrigram),
+    (9, 'history row per item and task', migrateTaskDecisions),
+    (10, 'worker metrics snapshots', migrateWorkerStats),
+]
+
+
+def schemaVersion(conn):
+    return conn.execute(sa.text('PRAGMA user_version')).scalar()
+
+
+# how long a starting process waits for another one migrating the database
+MIGRATE_LOCK_WAIT = 600
+
+
+def lockDatabase(conn):
+    # each try waits busy_timeout; a long step (e.g. an index rebuild) of
+    # another process outlasts it
+    deadline = time.monotonic() + MIGRATE_LOCK_WAIT
+    while True:
+        try:
+            conn.execute(sa.text('BEGIN IMMEDIATE'))
+            return
+        except sa.exc.OperationalError as e:
+            if 'locked' not in str(e) or time.monotonic() > deadline:
+                raise
+            logger.info('DB migrate: waiting for another process')
+
+
+def migrate(engine, createTables=None):
+    # processes starting together (--web and --worker, gunicorn workers)
+    # would all read the old user_version and apply the same steps. The
+    # write lock is taken first, then the tables are created and
+    # user_version read under it; the next process finds the work done.
+    with engine.connect() as conn:
+        dbapi = conn.connection.dbapi_connection
+        level = dbapi.isolation_level
+        # pysqlite would begin a deferred transaction on its own
+        dbapi.isolation_level = None
+        try:
+            with conn.begin():
+                lockDatabase(conn)
+                if createTables:
+                    createTables(conn)
+                migrateLocked(conn)
+        finally:
+            dbapi.isolation_level = level
+
+
+def migrateLocked(conn):
+    version = schemaVersion(conn)
+    for target, desc, step in MIGRATIONS:
+        if target <= version:
+            continue
+        logger.info(f'DB migrate: v{target} {desc}')
+        step(conn)
+        # PRAGMA does not take bound parameters
+        conn.execute(sa.text(f'PRAGMA user_version = {int(target)}'))
@@ -31,12 +31,39 @@ class configData():
     rcpshfile = ''
     symbolink = ''
     notifyPlex = False
+    infoWorkers = 4
+    siteConcurrency = 2
+    siteRate = 1.0
+    infoCacheFile = os.path.join(os.path.dirname(__file__), 'instance', 'infocache.sqlite')
+    infoCacheTTL = 72
+    infoCacheMB = 256
+    infoMaxKB = 512
+    taskWorkers = 4
+    jobJitter = 30
+    startDelay = 15
+    adaptiveMin = 1
+    adaptiveMax = 60
+    streamParse = True
+    stopAfterKnown = 20
+    keepRejectedDays = 0
+    keepAcceptedDays = 0
+    archiveDir = os.path.join(os.path.dirname(__file__), 'instance', 'archive')
+    webHost = '0.0.0.0'
+    webPort = 5009
+    webThreads = 8
 
 
 CONFIG = configData()
+# mtime of the config file when it was last read
+configMtime = None
 
 
 def readConfig(cfgFile):
+    global configMtime
+    try:
+        configMtime = os.stat(cfgFile).st_mtime_ns
+    except OSError:
+        configMtime = None
     config = configparser.ConfigParser()
     config.read(cfgFile)
 
@@ -54,12 +81,15 @@ def readConfig(cfgFile):
 
     if 'PLEX_SECTION' in config:
         configitems = config.items('PLEX_SECTION')
+        # a new list: the config is read again when the file changes
+        plexSectionList = []
         for key, value in configitems:
             if ',' in value:
-                CONFIG.plexSectionList += [(key, subval.strip())
-                                           for subval in value.split(',')]
+                plexSectionList += [(key, subval.strip())
+                                    for subval in value.split(',')]
             else:
-                CONFIG.plexSectionList.append((key, value))
+                plexSectionList.append((key, value))
+        CONFIG.plexSectionList = plexSectionList
         # print(configitems)
         # CONFIG.plexSectionList = [(key, value) for key,value in configitems ]
             #   config['PLEX'].get('sectionList', '')
@@ -101,6 +131,63 @@ def readConfig(cfgFile):
 
         CONFIG.rcpshfile = os.path.join(os.path.dirname(__file__), 'rcp.sh')
 
+    if 'RSS' in config:
+        # info page fetching: worker pool size, per-site parallel requests and requests/sec (0 no cap)
+        CONFIG.infoWorkers = config['RSS'].getint('info_workers', 4)
+        CONFIG.siteConcurrency = config['RSS'].getint('site_concurrency', 2)
+        CONFIG.siteRate = config['RSS'].getfloat('site_rate', 1.0)
+        # on-disk cache of info pages: file (empty to disable), ttl in hours, size in MB
+        CONFIG.infoCacheFile = config['RSS'].get('info_cache', CONFIG.infoCacheFile)
+        CONFIG.infoCacheTTL = config['RSS'].getint('info_cache_ttl', 72)
+        CONFIG.infoCacheMB = config['RSS'].getint('info_cache_mb', 256)
+        # info page download cap in KB, 0 reads whole pages
+        CONFIG.infoMaxKB = config['RSS'].getint('info_max_kb', 512)
+        # rss task runs: worker threads, random delay of each run in seconds,
+        # minutes before the first run after start
+        CONFIG.taskWorkers = config['RSS'].getint('workers', 4)
+        CONFIG.jobJitter = config['RSS'].getint('job_jitter', 30)
+        CONFIG.startDelay = config['RSS'].getint('start_delay', 15)
+        # bounds of the adaptive task interval, in minutes
+        CONFIG.adaptiveMin = config['RSS'].getfloat('adaptive_min', 1)
+        CONFIG.adaptiveMax = config['RSS'].getfloat('adaptive_max', 60)
+        # read feeds incrementally with lxml, and stop after this many
+        # consecutive known items (0 reads the whole feed)
+        CONFIG.streamParse = config['RSS'].getboolean('stream_parse', True)
+        CONFIG.stopAfterKnown = config['RSS'].getint('stop_after_known', 20)
+        # history retention in days, 0 keeps forever; expired rows go to
+        # archive_dir (empty to delete without archiving)
+        CONFIG.keepRejectedDays = config['RSS'].getint('keep_rejected_days', 0)
+        CONFIG.keepAcceptedDays = config['RSS'].getint('keep_accepted_days', 0)
+        CONFIG.archiveDir = config['RSS'].get('archive_dir', CONFIG.archiveDir)
+
+    if 'WEB' in config:
+        # web server address, and request threads of `python app.py`
+        CONFIG.webHost = config['WEB'].get('host', '0.0.0.0')
+        CONFIG.webPort = config['WEB'].getint('port', 5009)
+        CONFIG.webThreads = config['WEB'].getint('threads', 8)
+
+
+def reloadConfig(cfgFile):
+    # settings saved in the web UI reach the other processes (rss workers,
+    # other server processes) through the file: read it again once its
+    # mtime changed. Pool sizes and the web address still need a restart
+    try:
+        mtime = os.stat(cfgFile).st_mtime_ns
+    except OSError:
+        return False
+    if mtime == configMtime:
+        return False
+    readConfig(cfgFile)
+    return True
+
+
+def writeConfig(cfgFile, config):
+    # replaced in one step, a process reloading it never reads half a file
+    tmpFile = cfgFile + '.tmp'
+    with open(tmpFile, 'w') as f:
+        config.write(f)
+    os.replace(tmpFile, cfgFile)
+
 
 def generatePassword(cfgFile):
     config = configparser.ConfigParser()
@@ -117,8 +204,7 @@ def generatePassword(cfgFile):
     print('config file: %s' % cfgFile)
     print("username: %s \npassword: %s" %
           (CONFIG.basicAuthUser, CONFIG.basicAuthPass))
-    with open(cfgFile, 'w') as f:
-        config.write(f)
+    writeConfig(cfgFile, config)
 
 
 def updateMediaRootDir(cfgFile, mbRootDir):
@@ -127,8 +213,7 @@ def updateMediaRootDir(cfgFile, mbRootDir):
     if not config.has_section('TORCP'):
         config.add_section('TORCP')
     config.set('TORCP', 'mbrootdir', mbRootDir)
-    with open(cfgFile, 'w') as f:
-        config.write(f)
+    writeConfig(cfgFile, config)
     CONFIG.mbRootDir = config['TORCP'].get('mbrootdir', '')
 
 
@@ -147,8 +232,7 @@ def updateConfigSettings(cfgFile, linkDir, bracket, tmdbLang, lang, genre, tmdb_
     if not config.has_section('TMDB'):
         config.add_section('TMDB')
     config.set('TMDB', 'api_key', tmdb_api_key)
-    with open(cfgFile, 'w') as f:
-        config.write(f)
+    writeConfig(cfgFile, config)
 
     CONFIG.linkDir = config['TORCP'].get('linkdir', '')
     CONFIG.bracket = config['TORCP'].get('bracket', '')
@@ -169,8 +253,7 @@ def updateQBSettings(cfgFile, qbhost, qbport, qbuser, qbpass):
     config.set('QBIT', 'port', qbport)
     config.set('QBIT', 'user', qbuser)
     config.set('QBIT', 'pass', qbpass)
-    with open(cfgFile, 'w') as f:
-        config.write(f)
+    writeConfig(cfgFile, config)
 
     CONFIG.qbServer = config['QBIT'].get('server_ip', '')
     CONFIG.qbPort = config['QBIT'].get('port', '')
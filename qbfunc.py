@@ -4,12 +4,116 @@ import myconfig
 import urllib.parse
 import shutil
 import math
-import time
+import threading
 from loguru import logger
 logger = logger.bind(name='qbittorrent_mod')
 DISK_SPACE_MARGIN = 2004800000  # 2G before disk full
 
 
+class QbClientManager:
+    # one logged-in client shared by all threads, so the HTTP connection is
+    # reused between calls. qbittorrentapi logs in again by itself when a
+    # call gets 403 (expired session). Rebuilt only when the settings change.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.client = None
+        self.settings = None
+
+    def currentSettings(self):
+        return (myconfig.CONFIG.qbServer, myconfig.CONFIG.qbPort,
+                myconfig.CONFIG.qbUser, myconfig.CONFIG.qbPass)
+
+    def get(self):
+        with self.lock:
+            settings = self.currentSettings()
+            if self.client is None or settings != self.settings:
+                self.close()
+                client = qbittorrentapi.Client(
+                    host=settings[0], port=settings[1], username=settings[2], password=settings[3])
+                client.auth_log_in()
+                self.client = client
+                self.settings = settings
+            return self.client
+
+    def close(self):
+        if self.client is not None:
+            try:
+                self.client.auth_log_out()
+            except Exception:
+                pass
+        self.client = None
+        self.settings = None
+
+
+qbManager = QbClientManager()
+
+
+class TorrentSnapshot:
+    # local copy of the torrent list and server state, kept current with
+    # sync/maindata deltas (rid) instead of fetching torrents_info every time;
+    # the totals the space planner needs are aggregated on each refresh
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.client = None
+        self.rid = 0
+        self.torrents = {}
+        self.server_state = {}
+        self.amount_left = 0
+        self.completed = []
+
+    def refresh(self, client):
+        with self.lock:
+            if client is not self.client:
+                # new client (settings changed): start from a full update
+                self.client = client
+                self.rid = 0
+            data = client.sync_maindata(rid=self.rid)
+            if data.get('full_update'):
+                self.torrents = {}
+                self.server_state = {}
+            for torhash, fields in (data.get('torrents') or {}).items():
+                torrent = self.torrents.setdefault(torhash, {'hash': torhash})
+                torrent.update(fields)
+            for torhash in data.get('torrents_removed') or []:
+                self.torrents.pop(torhash, None)
+            self.server_state.update(data.get('server_state') or {})
+            self.rid = data.get('rid', self.rid)
+            self.aggregate()
+
+    def aggregate(self):
+        torrents = self.torrents.values()
+        self.amount_left = sum(
+            x.get('amount_left', 0) for x in torrents if x.get('progress', 0) < 1)
+        # completed torrents, longest seeding first
+        self.completed = sorted(
+            [x for x in torrents if x.get('progress', 0) == 1],
+            key=lambda t: t.get('seeding_time', 0),
+            reverse=True)
+
+    def removeTorrents(self, hashes):
+        # deleted through the API, drop them before the next delta arrives
+        with self.lock:
+            for torhash in hashes:
+                self.torrents.pop(torhash, None)
+            self.aggregate()
+
+    def freeSpace(self):
+        return self.server_state.get('free_space_on_disk', -1)
+
+
+torrentSnapshot = TorrentSnapshot()
+
+
+def getQbClient():
+    try:
+        return qbManager.get()
+    except qbittorrentapi.LoginFailed as e:
+        print(e)
+    except Exception as e:
+        logger.error(f'Fail to connect to qBittorrent: {e}')
+    return None
+
+
 def getTorrentFirstTracker(torrent):
     noneTracker = {"url": "", "msg": ""}
     firstTracker = next(
@@ -29,12 +133,8 @@ def abbrevTracker(trackerstr):
 
 
 def getTorrentByHash(torhash):
-    qbClient = qbittorrentapi.Client(
-        host=myconfig.CONFIG.qbServer, port=myconfig.CONFIG.qbPort, username=myconfig.CONFIG.qbUser, password=myconfig.CONFIG.qbPass)
-
-    try:
-        qbClient.auth_log_in()
-    except:
+    qbClient = getQbClient()
+    if not qbClient:
         return '', '', '', '', '', ''
 
     # if not qbClient:
@@ -58,17 +158,7 @@ def getTorrentByHash(torhash):
 
 
 def getAutoRunProgram():
-    qbClient = qbittorrentapi.Client(
-        host=myconfig.CONFIG.qbServer, port=myconfig.CONFIG.qbPort, username=myconfig.CONFIG.qbUser, password=myconfig.CONFIG.qbPass)
-
-    try:
-        qbClient.auth_log_in()
-    except qbittorrentapi.LoginFailed as e:
-        print(e)
-        return False
-    except:
-        return False
-
+    qbClient = getQbClient()
     if not qbClient:
         return False
 
@@ -78,17 +168,7 @@ def getAutoRunProgram():
 
 
 def setAutoRunProgram(prog):
-    qbClient = qbittorrentapi.Client(
-        host=myconfig.CONFIG.qbServer, port=myconfig.CONFIG.qbPort, username=myconfig.CONFIG.qbUser, password=myconfig.CONFIG.qbPass)
-
-    try:
-        qbClient.auth_log_in()
-    except qbittorrentapi.LoginFailed as e:
-        print(e)
-        return False
-    except:
-        return False
-
+    qbClient = getQbClient()
     if not qbClient:
         return False
 
@@ -98,6 +178,7 @@ def setAutoRunProgram(prog):
 
 
 def qbDeleteTorrent(qbClient, tor_hash):
+    # tor_hash: one hash or a list, deleted in one call
     try:
         qbClient.torrents_delete(True, torrent_hashes=tor_hash)
     except Exception as ex:
@@ -123,119 +204,76 @@ def get_free_space():
     # _, _, free = psutil.disk_usage('/')
     # return free
     # TODO: api/psutil, which one?
-    qbClient = qbittorrentapi.Client(
-        host=myconfig.CONFIG.qbServer, port=myconfig.CONFIG.qbPort, username=myconfig.CONFIG.qbUser, password=myconfig.CONFIG.qbPass)
-
-    try:
-        qbClient.auth_log_in()
-    except qbittorrentapi.LoginFailed as e:
-        print(e)
-        return -1
-
+    qbClient = getQbClient()
     if not qbClient:
         return -1
 
     try:
-        r = qbClient.sync_maindata(rid=0)
-        return r['server_state']['free_space_on_disk']
+        torrentSnapshot.refresh(qbClient)
+        return torrentSnapshot.freeSpace()
     except Exception:
         logger.error('Error getting qBittorrent main data.')
         return -1
 
 
-def space_for_torrent(client, torrents, entry, size_storage_space):
-    size_new_torrent = entry.size
-    # logger.info('New torrent: %s, need %s.' %
-    #             (entry.title, convert_size(size_new_torrent)))
-
-    # for all Downloading torrents in qbit, calculate bytes left to download
-    size_left_to_complete = 0
-    # uncompleted_torrents = [x for x in torrents if (x['state'] == 'downloading'] or x['state'] == 'stalledDL']) ]
-    uncompleted_torrents = [x for x in torrents if x['progress'] < 1]
-    for torrent in uncompleted_torrents:
-        size_left_to_complete += torrent['amount_left']
-        # size_left_to_complete += (torrent['total_size'] - torrent['downloaded'])
-    # logger.info('Uncomplete download: %s.' %
-    #             convert_size(size_left_to_complete))
-
-    remain_space = size_storage_space - size_left_to_complete
-    logger.info(f'   >> (hdd_free) {human_size(size_storage_space)} - (uncomplete) {human_size(size_left_to_complete)} - '
-                f'(new_tor) {human_size(size_new_torrent)} = {human_size(remain_space - size_new_torrent)}.')
-    # logger.info(f'  (remain_space - size_new_torrent) = {remain_space - size_new_torrent}.')
-    if (remain_space - size_new_torrent) > DISK_SPACE_MARGIN:
-        # if size_storage_space - size_left_to_complete - size_new_torrent > DISK_SPACE_MARGIN:
-        # enough space to add the new torrent
-        logger.info(
-            f'   => Add : ({human_size(size_new_torrent)}) {entry.title}.')
-        return True
-
-    # Sort completed torrents by seeding time
-    completed_torrents = sorted(
-        [x for x in torrents if x['progress'] == 1],
-        key=lambda t: t['seeding_time'],
-        reverse=True
-    )
-    logger.info(
-        f'   -- {len(completed_torrents)}/{len(torrents)} finished/total torrents.')
-
-    # Loop through completed torrents and delete until there is enough space
-    torrents_to_del = []
+class SpacePlan:
+    def __init__(self):
+        self.accepted = []
+        self.rejected = []
+        self.to_delete = []
+
+
+def plan_space_for_torrents(snapshot, entries, size_storage_space):
+    # one plan for all the torrents of a run, in order: a torrent is added if
+    # hdd_free + deleted - uncomplete - (new torrents so far) stays above the
+    # margin, deleting more completed torrents (longest seeding first) when
+    # needed; when even deleting all of them is not enough it is skipped and
+    # nothing is deleted for it
+    plan = SpacePlan()
+    size_left_to_complete = snapshot.amount_left
+    completed_torrents = snapshot.completed
     space_to_del = 0
-    for tor_complete in completed_torrents:
-        torrents_to_del.append(tor_complete)
-        space_to_del += tor_complete['downloaded']
-        logger.info(
-            f'   >> {tor_complete["name"]} : {human_size(tor_complete["downloaded"])} ')
-        logger.info(f'   :: size_storage_space({human_size(size_storage_space)}) + space_to_del({human_size(space_to_del)}) '
-                    f'- size_left_to_complete ({human_size(size_left_to_complete)}) '
-                    f'- size_new_torrent ({human_size(size_new_torrent)}) '
-                    f'= {human_size(size_storage_space + space_to_del - size_left_to_complete - size_new_torrent)}')
-        if (size_storage_space + space_to_del - size_left_to_complete - size_new_torrent) > DISK_SPACE_MARGIN:
-            for tor_to_del in torrents_to_del:
-                logger.warning(
-                    f'   Deleting: {tor_to_del["name"]} to free {human_size(tor_to_del["downloaded"])}.')
-                qbDeleteTorrent(client, tor_to_del['hash'])
-                time.sleep(3)
-            # Enough space now available, add the new torrent
-            # time.sleep(5)
-            # size_storage_space = get_free_space(client)
-            # logger.info('Free space: %s.' % convert_size(size_storage_space))
-            return True
-    remain_space = size_storage_space + space_to_del - size_left_to_complete
-    # logger.info('   !!! not enough: %s + %s - %s = %s.' % (convert_size(size_storage_space), convert_size(space_to_del), convert_size(
-    #     size_left_to_complete), convert_size(remain_space)))
-
-    return False
-
-
-def addQbitWithTag(entry, size_storage_space):
-    qbClient = qbittorrentapi.Client(
-        host=myconfig.CONFIG.qbServer, port=myconfig.CONFIG.qbPort, username=myconfig.CONFIG.qbUser, password=myconfig.CONFIG.qbPass)
+    size_new_torrents = 0
+    for entry in entries:
+        extra = []
+        extra_space = 0
+        next_del = len(plan.to_delete)
+        while (size_storage_space + space_to_del + extra_space - size_left_to_complete
+               - size_new_torrents - entry.size) <= DISK_SPACE_MARGIN:
+            if next_del >= len(completed_torrents):
+                break
+            extra.append(completed_torrents[next_del])
+            extra_space += completed_torrents[next_del]['downloaded']
+            next_del += 1
+        remain = (size_storage_space + space_to_del + extra_space - size_left_to_complete
+                  - size_new_torrents - entry.size)
+        if remain > DISK_SPACE_MARGIN:
+            plan.accepted.append(entry)
+            plan.to_delete += extra
+            space_to_del += extra_space
+            size_new_torrents += entry.size
+        else:
+            plan.rejected.append(entry)
 
-    try:
-        qbClient.auth_log_in()
-    except qbittorrentapi.LoginFailed as e:
-        print(e)
-        return False
+    logger.info(f'   >> (hdd_free) {human_size(size_storage_space)} + (delete {len(plan.to_delete)}/{len(completed_torrents)}) '
+                f'{human_size(space_to_del)} - (uncomplete) {human_size(size_left_to_complete)} - '
+                f'(new {len(plan.accepted)}/{len(entries)}) {human_size(size_new_torrents)} '
+                f'= {human_size(size_storage_space + space_to_del - size_left_to_complete - size_new_torrents)}.')
+    return plan
 
-    if not qbClient:
-        return False
 
-    try:
-        torrents = qbClient.torrents_info()
-        # logger.info(f'   >>  {len(torrents)} torrents in client.')
-    except:
-        logger.debug('  !! Fail to load torrent list.')
-        # client.disconnect()
-        return False
+def apply_space_plan(client, snapshot, plan):
+    if not plan.to_delete:
+        return
+    for tor_to_del in plan.to_delete:
+        logger.warning(
+            f'   Deleting: {tor_to_del["name"]} to free {human_size(tor_to_del["downloaded"])}.')
+    hashes = [x['hash'] for x in plan.to_delete]
+    qbDeleteTorrent(client, hashes)
+    snapshot.removeTorrents(hashes)
 
-    # logger.info(f'   >> Free space: {convert_size(size_storage_space)}.')
-    enough_space = space_for_torrent(
-        qbClient, torrents, entry, size_storage_space)
-    if not enough_space:
-        logger.info(f'   !! No enough space. Skip: {entry.title}')
-        return False
 
+def addQbitTorrent(qbClient, entry):
     try:
         if entry.siteid_str:
             result = qbClient.torrents_add(
@@ -263,16 +301,34 @@ def addQbitWithTag(entry, size_storage_space):
     return True
 
 
-def addQbitFileWithTag(filecontent, imdbtag, siteIdStr=None):
-    qbClient = qbittorrentapi.Client(
-        host=myconfig.CONFIG.qbServer, port=myconfig.CONFIG.qbPort, username=myconfig.CONFIG.qbUser, password=myconfig.CONFIG.qbPass)
+def addQbitBatchWithTag(entries, size_storage_space):
+    # returns a list of True/False, one per entry
+    qbClient = getQbClient()
+    if not qbClient:
+        return [False] * len(entries)
 
     try:
-        qbClient.auth_log_in()
-    except qbittorrentapi.LoginFailed as e:
-        print(e)
-        return False
+        torrentSnapshot.refresh(qbClient)
+        # logger.info(f'   >>  {len(torrentSnapshot.torrents)} torrents in client.')
+    except:
+        logger.debug('  !! Fail to load torrent list.')
+        # client.disconnect()
+        return [False] * len(entries)
+
+    plan = plan_space_for_torrents(torrentSnapshot, entries, size_storage_space)
+    for entry in plan.rejected:
+        logger.info(f'   !! No enough space. Skip: {entry.title}')
+    apply_space_plan(qbClient, torrentSnapshot, plan)
 
+    # one torrents_add per torrent: each gets its own save path
+    # (genrSiteId, <site>_<id>[_<imdb>]) and imdb tag, which a multi-url
+    # call cannot set per url
+    added = {id(entry): addQbitTorrent(qbClient, entry) for entry in plan.accepted}
+    return [added.get(id(entry), False) for entry in entries]
+
+
+def addQbitFileWithTag(filecontent, imdbtag, siteIdStr=None):
+    qbClient = getQbClient()
     if not qbClient:
         return False
 
@@ -0,0 +1,108 @@
+import os
+import gzip
+import json
+import hashlib
+from datetime import datetime, timedelta
+import sqlalchemy as sa
+from loguru import logger
+
+# History retention: expired rss_history rows are written to a gzip'ed
+# JSONL archive and deleted. The guid / title of every archived row stays in
+# rss_seen as a 64-bit hash, so dedup still recognises those items.
+
+ARCHIVE_BATCH = 5000
+# full VACUUM (once, switching to incremental auto_vacuum) when this share
+# of the file is free pages
+VACUUM_FREE_RATIO = 0.25
+
+
+def seenKey(kind, value):
+    # kind 'g' for guid, 't' for title; signed to fit an sqlite INTEGER
+    digest = hashlib.blake2b(f'{kind}:{value}'.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+def itemSeenKeys(guid, title):
+    keys = []
+    if guid:
+        keys.append(seenKey('g', guid))
+    if title:
+        keys.append(seenKey('t', title))
+    return keys
+
+
+def expiredWhere(keepRejectedDays, keepAcceptedDays, now):
+    conds = []
+    params = {}
+    if keepRejectedDays > 0:
+        conds.append('(accept != 3 AND addedon < :rejected_before)')
+        params['rejected_before'] = (now - timedelta(days=keepRejectedDays)).strftime('%Y-%m-%d %H:%M:%S')
+    if keepAcceptedDays > 0:
+        conds.append('(accept = 3 AND addedon < :accepted_before)')
+        params['accepted_before'] = (now - timedelta(days=keepAcceptedDays)).strftime('%Y-%m-%d %H:%M:%S')
+    return ' OR '.join(conds), params
+
+
+def archiveHistory(engine, archiveDir, keepRejectedDays, keepAcceptedDays):
+    # returns the number of rows removed from rss_history
+    now = datetime.now()
+    where, params = expiredWhere(keepRejectedDays, keepAcceptedDays, now)
+    if not where:
+        return 0
+
+    archive = None
+    if archiveDir:
+        os.makedirs(archiveDir, exist_ok=True)
+        path = os.path.join(archiveDir, f'rss_history-{now.strftime("%Y%m%d-%H%M%S")}.jsonl.gz')
+        archive = gzip.open(path, 'at', encoding='utf-8')
+
+    removed = 0
+    select = sa.text(f'SELECT * FROM rss_history WHERE {where} ORDER BY id LIMIT {ARCHIVE_BATCH}')
+    delete = sa.text('DELETE FROM rss_history WHERE id IN :ids').bindparams(
+        sa.bindparam('ids', expanding=True))
+    try:
+        while True:
+            with engine.begin() as conn:
+                rows = conn.execute(select, params).mappings().fetchall()
+                if not rows:
+                    break
+                # the archive is written before the rows are deleted; a crash
+                # in between archives the batch twice, never loses it
+                if archive:
+                    for row in rows:
+                        archive.write(json.dumps(dict(row), ensure_ascii=False, default=str) + '\n')
+                    archive.flush()
+                keys = [{'key': k} for row in rows for k in itemSeenKeys(row['guid'], row['title'])]
+                if keys:
+                    conn.execute(sa.text('INSERT OR IGNORE INTO rss_seen (key) VALUES (:key)'), keys)
+                conn.execute(delete, {'ids': [row['id'] for row in rows]})
+            removed += len(rows)
+    finally:
+        if archive:
+            archive.close()
+            if not removed:
+                os.remove(path)
+    if removed:
+        logger.info(f'History retention: archived {removed} rows' + (f' to {path}' if archive else ''))
+    return removed
+
+
+def compactDatabase(engine):
+    # hand free pages back to the file system: incremental vacuum once the
+    # database has been switched to it, otherwise one full VACUUM that also
+    # does the switch, only when a good part of the file is free
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        pageCount = conn.exec_driver_sql('PRAGMA page_count').scalar()
+        freePages = conn.exec_driver_sql('PRAGMA freelist_count').scalar()
+        if not freePages:
+            return
+        if conn.exec_driver_sql('PRAGMA auto_vacuum').scalar() == 2:
+            # frees one page per step; executescript runs it to the end
+            conn.connection.executescript('PRAGMA incremental_vacuum;')
+        elif freePages > pageCount * VACUUM_FREE_RATIO:
+            logger.info(f'History retention: VACUUM, {freePages} of {pageCount} pages free')
+            conn.exec_driver_sql('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.exec_driver_sql('VACUUM')
+        else:
+            return
+        conn.exec_driver_sql('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
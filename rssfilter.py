@@ -0,0 +1,198 @@
+import re
+import time
+import threading
+from loguru import logger
+
+# log a rule whose single match takes longer than this (seconds)
+SLOW_MATCH = 0.05
+# rules keep their canonical order until each has this many checks, and
+# the plan is redone every PLAN_EVERY items of a stage
+PLAN_MIN_CHECKS = 20
+PLAN_EVERY = 100
+GB = 1024 ** 3
+
+
+class RuleStat:
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.count = 0
+        self.rejected = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def rank(self):
+        # expected time spent per item rejected: cheap and selective first
+        if self.count < PLAN_MIN_CHECKS:
+            return None
+        if not self.rejected:
+            return float('inf')
+        return self.total / self.rejected
+
+    def to_dict(self):
+        return {
+            'pattern': self.pattern,
+            'count': self.count,
+            'rejected': self.rejected,
+            'total_ms': round(self.total * 1000, 3),
+            'avg_ms': round(self.total * 1000 / self.count, 3) if self.count else 0,
+            'max_ms': round(self.max * 1000, 3),
+        }
+
+
+class TaskFilter:
+    # compiled rules of one RSSTask. The reject reason of an item is the
+    # first failing rule of its stage in the canonical order below (the
+    # order processRssFeeds always applied them); the rules themselves run
+    # cheapest per rejection first, see firstReason. Reason strings are
+    # the RSSHistory.reason
+    RULES = [
+        ('title_regex', 'TITLE_REGEX', re.I, True),
+        ('title_not_regex', 'TITLE_NOT_REGEX', re.I, False),
+        ('info_regex', 'INFO_REGEX', re.A, True),
+        ('info_not_regex', 'INFO_NOT_REGEX', re.A, False),
+    ]
+    # before the info page fetch, and on the info page
+    TITLE_STAGE = ('size', 'title_regex', 'title_not_regex')
+    INFO_STAGE = ('info_regex', 'info_not_regex', 'min_imdb')
+
+    def __init__(self, rsstask):
+        self.tid = rsstask.id
+        self.signature = ruleSignature(rsstask)
+        self.sizeMin = rsstask.size_min
+        self.sizeMax = rsstask.size_max
+        self.minImdb = rsstask.min_imdb
+        self.rules = {}
+        self.stats = {'size': RuleStat(f'{self.sizeMin} - {self.sizeMax} GB')}
+        self.lock = threading.Lock()
+        for field, reason, flags, must_match in self.RULES:
+            pattern = getattr(rsstask, field)
+            if pattern:
+                # raises re.error, or ValueError for a flag the rule's
+                # flags exclude (e.g. (?u) with re.A)
+                self.rules[field] = (re.compile(pattern, flags), reason, must_match)
+                self.stats[field] = RuleStat(pattern)
+        if self.minImdb:
+            self.stats['min_imdb'] = RuleStat(f'>= {self.minImdb}')
+        self.plans = {}
+        self.planned = {}
+
+    def regex(self, field):
+        # compiled pattern of a regex rule, None when not set
+        rule = self.rules.get(field)
+        return rule[0] if rule else None
+
+    def _test(self, field, value):
+        # returns the reject reason, or None when the rule passes
+        if field == 'size':
+            size_gb = value / GB
+            return 'SIZE_MIN_MAX' if size_gb < self.sizeMin or size_gb > self.sizeMax else None
+        if field == 'min_imdb':
+            if value.imdbval < self.minImdb and value.doubanval < self.minImdb:
+                return "IMDb: %s, douban: %s" % (value.imdbval, value.doubanval)
+            return None
+        regex, reason, must_match = self.rules[field]
+        matched = regex.search(value) is not None
+        return None if matched == must_match else reason
+
+    def _check(self, field, value):
+        start = time.perf_counter()
+        reason = self._test(field, value)
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            stat = self.stats[field]
+            stat.count += 1
+            stat.total += elapsed
+            stat.max = max(stat.max, elapsed)
+            if reason:
+                stat.rejected += 1
+        if elapsed > SLOW_MATCH:
+            logger.warning(f'   !! slow rule {field} of task {self.tid}: {elapsed * 1000:.1f} ms')
+        return reason
+
+    def _plan(self, stage):
+        # the stage's rules by measured cost per rejection; canonical order
+        # while a rule has too few checks to tell
+        with self.lock:
+            count = self.planned.get(stage, 0)
+            self.planned[stage] = count + 1
+            plan = self.plans.get(stage)
+            if plan is not None and count % PLAN_EVERY:
+                return plan
+            fields = [f for f in stage if f in self.stats]
+            ranks = [self.stats[f].rank() for f in fields]
+            if None not in ranks:
+                fields = [f for _, f in sorted(zip(ranks, fields), key=lambda x: x[0])]
+            self.plans[stage] = fields
+            return fields
+
+    def firstReason(self, stage, values):
+        # runs the rules in plan order; after a rule fails, only the rules
+        # before it in the canonical order still run, so the reason is the
+        # same as checking them in canonical order
+        failed, reason = len(stage), None
+        for field in self._plan(stage):
+            i = stage.index(field)
+            if i > failed:
+                continue
+            r = self._check(field, values[field])
+            if r:
+                failed, reason = i, r
+        return reason
+
+    def titleReason(self, title, size):
+        return self.firstReason(self.TITLE_STAGE, {
+            'size': size, 'title_regex': title, 'title_not_regex': title})
+
+    def infoReason(self, page):
+        return self.firstReason(self.INFO_STAGE, {
+            'info_regex': page.doc, 'info_not_regex': page.doc, 'min_imdb': page})
+
+    def to_dict(self):
+        with self.lock:
+            return {field: stat.to_dict() for field, stat in self.stats.items()}
+
+
+def ruleSignature(rsstask):
+    return tuple(getattr(rsstask, field) or '' for field, _, _, _ in TaskFilter.RULES) + (
+        rsstask.size_min, rsstask.size_max, rsstask.min_imdb)
+
+
+def validateRegex(pattern, field):
+    # returns an error message, or '' for a valid (or empty) pattern;
+    # compiled with the flags TaskFilter uses for the field
+    if not pattern:
+        return ''
+    flags = next(f for name, _, f, _ in TaskFilter.RULES if name == field)
+    try:
+        re.compile(pattern, flags)
+    except (re.error, ValueError) as e:
+        return str(e)
+    return ''
+
+
+_filters = {}
+_filtersLock = threading.Lock()
+
+
+def getTaskFilter(rsstask):
+    # cached per task, rebuilt when the rules differ from the cached ones,
+    # e.g. the task was edited in another process
+    with _filtersLock:
+        taskfilter = _filters.get(rsstask.id)
+        if taskfilter and taskfilter.signature == ruleSignature(rsstask):
+            return taskfilter
+    taskfilter = TaskFilter(rsstask)
+    with _filtersLock:
+        _filters[rsstask.id] = taskfilter
+    return taskfilter
+
+
+def invalidateTaskFilter(tid):
+    with _filtersLock:
+        _filters.pop(tid, None)
+
+
+def allRuleStats():
+    with _filtersLock:
+        filters = list(_filters.values())
+    return {f.tid: f.to_dict() for f in filters}
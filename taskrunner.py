@@ -0,0 +1,117 @@
+import time
+import threading
+from loguru import logger
+
+# Runs rss tasks on a fixed pool of worker threads. The scheduler jobs only
+# submit task ids here, so a burst of due jobs queues up instead of hitting
+# sqlite, qBittorrent and the trackers all at once:
+#   - a task that is queued or running is not queued again (no overlap)
+#   - at most one task per site runs at a time, later ones wait in the queue
+#   - queue wait (lag) and run time are kept per task for /api/schedstats
+
+
+class TaskStat:
+    def __init__(self):
+        self.runs = 0
+        self.skipped = 0
+        self.failed = 0
+        self.lastLag = 0.0
+        self.maxLag = 0.0
+        self.lastDuration = 0.0
+        self.lastStart = None
+
+    def to_dict(self):
+        return {
+            'runs': self.runs,
+            'skipped': self.skipped,
+            'failed': self.failed,
+            'last_lag': round(self.lastLag, 3),
+            'max_lag': round(self.maxLag, 3),
+            'last_duration': round(self.lastDuration, 3),
+            'last_start': self.lastStart,
+        }
+
+
+class TaskRunner:
+    def __init__(self, run):
+        # run(tid) does the work of one task
+        self.run = run
+        self.cond = threading.Condition()
+        self.pending = []   # (tid, site, queued at), in submit order
+        self.queued = set()
+        self.running = {}   # tid -> site
+        self.busySites = set()
+        self.stats = {}
+        self.threads = []
+
+    def start(self, workers):
+        with self.cond:
+            while len(self.threads) < max(1, workers):
+                t = threading.Thread(target=self._worker, daemon=True,
+                                     name=f'rss-worker-{len(self.threads)}')
+                self.threads.append(t)
+                t.start()
+
+    def submit(self, tid, site):
+        # returns False when the task is already queued or running
+        with self.cond:
+            stat = self.stats.setdefault(tid, TaskStat())
+            if tid in self.queued or tid in self.running:
+                stat.skipped += 1
+                logger.info(f'Task {tid} still queued or running, skip this round')
+                return False
+            self.pending.append((tid, site, time.monotonic()))
+            self.queued.add(tid)
+            self.cond.notify()
+            return True
+
+    def _next(self):
+        with self.cond:
+            while True:
+                for i, (tid, site, queuedAt) in enumerate(self.pending):
+                    if site not in self.busySites:
+                        del self.pending[i]
+                        self.queued.discard(tid)
+                        self.running[tid] = site
+                        self.busySites.add(site)
+                        stat = self.stats.setdefault(tid, TaskStat())
+                        stat.lastLag = time.monotonic() - queuedAt
+                        stat.maxLag = max(stat.maxLag, stat.lastLag)
+                        stat.lastStart = time.time()
+                        return tid
+                self.cond.wait()
+
+    def _worker(self):
+        while True:
+            tid = self._next()
+            start = time.monotonic()
+            failed = False
+            try:
+                self.run(tid)
+            except Exception as e:
+                failed = True
+                logger.exception(f'Task {tid} failed: {e}')
+            with self.cond:
+                site = self.running.pop(tid, None)
+                self.busySites.discard(site)
+                stat = self.stats[tid]
+                stat.runs += 1
+                stat.failed += failed
+                stat.lastDuration = time.monotonic() - start
+                # a waiting task of this site may run now
+                self.cond.notify_all()
+
+    def forget(self, tid):
+        with self.cond:
+            self.stats.pop(tid, None)
+
+    def metrics(self):
+        with self.cond:
+            now = time.monotonic()
+            return {
+                'workers': len(self.threads),
+                'queue_depth': len(self.pending),
+                'running': len(self.running),
+                'oldest_wait': round(max((now - q for _, _, q in self.pending), default=0), 3),
+                'tasks': {tid: s.to_dict() for tid, s in self.stats.items()},
+            }
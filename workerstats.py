@@ -0,0 +1,37 @@
+import json
+from datetime import datetime, timedelta
+import sqlalchemy as sa
+import lease
+
+# Metrics of the worker processes for the web process: with --web or
+# createApp() the web process runs no jobs, each worker writes a snapshot
+# of its stage histograms, rule stats and pool stats to worker_stats on
+# every job sync. Snapshots of workers gone for STATS_TTL are left out.
+
+STATS_TTL = lease.LEASE_TTL
+
+
+def publish(engine, data):
+    now = datetime.now()
+    with engine.begin() as conn:
+        conn.execute(sa.text(
+            'INSERT INTO worker_stats (worker, updated, data) VALUES (:worker, :updated, :data) '
+            'ON CONFLICT(worker) DO UPDATE SET updated = excluded.updated, data = excluded.data'),
+            {'worker': lease.WORKER_ID, 'updated': lease.timestamp(now), 'data': json.dumps(data)})
+        conn.execute(sa.text('DELETE FROM worker_stats WHERE updated < :stale'),
+                     {'stale': lease.timestamp(now - timedelta(days=1))})
+
+
+def collect(engine, exclude=None):
+    # snapshots of the live workers but `exclude`
+    with engine.connect() as conn:
+        rows = conn.execute(sa.text(
+            'SELECT worker, data FROM worker_stats WHERE updated >= :since'),
+            {'since': lease.timestamp(datetime.now() - timedelta(seconds=STATS_TTL))}).fetchall()
+    return [json.loads(r[1]) for r in rows if r[0] != exclude]
+
+
+def remove(engine, worker=lease.WORKER_ID):
+    with engine.begin() as conn:
+        conn.execute(sa.text('DELETE FROM worker_stats WHERE worker = :worker'),
+                     {'worker': worker})